@@ -0,0 +1,272 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# قياس أداء البوت بدون إنترنت: خادم محلي يحاكي Bot API، وسيناريو سائقين وركاب كامل
+# الاستخدام: python benchmark.py --drivers 200 --passengers 200
+# النتائج تُضاف كسطر JSON إلى bench_output.txt مع رقم الـ commit للمقارنة بين النسخ
+
+DRIVER_TEXTS = {"start": "/start", "role": "سائق 🚖", "available": "متوفر ✅",
+                "accept": "/قبول ✅", "reject": "/رفض ❌", "pickup": "تم استلام الراكب 🚶", "deliver": "تم توصيل الراكب 🏁"}
+PASSENGER_TEXTS = {"start": "/start", "role": "راكب 🧍", "request": "طلب رحلة 🛺"}
+GENDERS = ["ذكر 👨", "أنثى 👩"]
+
+# =================== خادم Bot API وهمي ===================
+
+class FakeTelegramApi(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.handle_method()
+
+    def do_GET(self):
+        self.handle_method()
+
+    def handle_method(self):
+        method = self.path.rsplit("/", 1)[-1].split("?")[0]
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        params = self.parse_params(body)
+        server = self.server
+        if method == "sendMessage":
+            chat_id = int(params.get("chat_id", 0))
+            with server.lock:
+                server.message_id += 1
+                message_id = server.message_id
+                server.sent.append((time.perf_counter(), chat_id, params.get("text", "")))
+            result = {"message_id": message_id, "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        else:
+            result = True
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def parse_params(self, body):
+        from urllib.parse import parse_qs, urlsplit
+        params = {k: v[0] for k, v in parse_qs(urlsplit(self.path).query).items()}
+        if body:
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                params.update(json.loads(body))
+            else:
+                params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+        return params
+
+    def log_message(self, format, *args):
+        pass
+
+def start_fake_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeTelegramApi)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.message_id = 0
+    server.sent = []
+    threading.Thread(target=server.serve_forever, name="fake-telegram-api", daemon=True).start()
+    return server
+
+# =================== القياس ===================
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+class Sampler:
+    # يسجل أعلى عدد خيوط أثناء التشغيل
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak_threads = threading.active_count()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="bench-sampler", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return ""
+
+class Benchmark:
+    def __init__(self, main, api, concurrency):
+        self.main = main
+        self.api = api
+        self.pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bench-user")
+        self.latencies = {}
+        self.lock = threading.Lock()
+        self.updates = 0
+
+    def deliver(self, phase, update):
+        from telebot import types
+        started = time.perf_counter()
+        self.main.bot.process_new_updates([types.Update.de_json(update)])
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.latencies.setdefault(phase, []).append(elapsed)
+            self.updates += 1
+
+    def run_scripts(self, phase, scripts):
+        # كل مستخدم ينفذ خطواته بالترتيب، والمستخدمون يعملون بالتوازي
+        def run(script):
+            for update in script:
+                self.deliver(phase, update)
+        for future in [self.pool.submit(run, script) for script in scripts]:
+            future.result()
+
+    def wait_for_outbound(self, timeout=60):
+        self.main.outbound.flush(timeout)
+
+    def offers_since(self, index):
+        with self.api.lock:
+            sent = self.api.sent[index:]
+        return [(at, chat_id) for at, chat_id, text in sent if text.startswith("🚨")]
+
+def run(args):
+    from webhook_client import fake_text_update, fake_location_update
+
+    api = start_fake_api()
+    import telebot
+    telebot.apihelper.API_URL = f"http://127.0.0.1:{api.server_address[1]}/bot{{0}}/{{1}}"
+    import main
+    main.setup()
+    main.bot.threaded = False
+
+    rng = random.Random(args.seed)
+    drivers = list(range(1_000_000, 1_000_000 + args.drivers))
+    passengers = list(range(2_000_000, 2_000_000 + args.passengers))
+    gender = {user_id: rng.choice(GENDERS) for user_id in drivers + passengers}
+    bench = Benchmark(main, api, args.concurrency)
+    sampler = Sampler()
+    statements_before = main.db_statements
+    phases = {}
+
+    def timed(name, func):
+        started = time.perf_counter()
+        func()
+        phases[name] = time.perf_counter() - started
+
+    # 1) التسجيل
+    timed("register", lambda: bench.run_scripts("register", [
+        [fake_text_update(u, DRIVER_TEXTS["start"]), fake_text_update(u, DRIVER_TEXTS["role"]), fake_text_update(u, gender[u])]
+        for u in drivers
+    ] + [
+        [fake_text_update(u, PASSENGER_TEXTS["start"]), fake_text_update(u, PASSENGER_TEXTS["role"]), fake_text_update(u, gender[u])]
+        for u in passengers
+    ]))
+    # 2) السائقون متوفرون
+    timed("available", lambda: bench.run_scripts("available", [[fake_text_update(u, DRIVER_TEXTS["available"])] for u in drivers]))
+    bench.wait_for_outbound()
+
+    # 3) الركاب يطلبون رحلات
+    offers_index = len(api.sent)
+    def request_trips():
+        bench.run_scripts("request", [[
+            fake_text_update(u, PASSENGER_TEXTS["request"]),
+            fake_location_update(u, 32.85 + rng.uniform(-0.05, 0.05), 13.15 + rng.uniform(-0.05, 0.05)),
+            fake_text_update(u, f"وجهة {u}"),
+            fake_text_update(u, str(rng.randint(5, 30)))
+        ] for u in passengers])
+        time.sleep(main.DISPATCH_WINDOW * 1.5 if main.DISPATCH_MODE == "batch" else 0)
+        bench.wait_for_outbound()
+    timed("request", request_trips)
+    offers = bench.offers_since(offers_index)
+
+    # 4) السائقون يقبلون أو يرفضون ثم يوصلون الركاب
+    offered_drivers = sorted({chat_id for _, chat_id in offers})
+    rejecting = {d for d in offered_drivers if rng.random() < args.reject_ratio}
+    timed("respond", lambda: bench.run_scripts("respond", [
+        [fake_text_update(d, DRIVER_TEXTS["reject"])] if d in rejecting else
+        [fake_text_update(d, DRIVER_TEXTS["accept"]), fake_text_update(d, DRIVER_TEXTS["pickup"]), fake_text_update(d, DRIVER_TEXTS["deliver"])]
+        for d in offered_drivers
+    ]))
+    bench.wait_for_outbound()
+
+    # 5) الركاب يقيمون السائقين
+    rating_chats = {chat_id for _, chat_id, text in api.sent if text.startswith("🔔 تم انتهاء الرحلة")}
+    timed("rate", lambda: bench.run_scripts("rate", [[fake_text_update(p, f"{rng.randint(1, 5)}⭐")] for p in rating_chats]))
+    bench.wait_for_outbound()
+    sampler.stop()
+
+    all_latencies = [x for values in bench.latencies.values() for x in values]
+    statements = main.db_statements - statements_before
+    # المطابقة = قبول سائق للرحلة (وليس عدد العروض: الرفض وعروض fanout تُحسب عروضًا فقط)
+    matched = main.db_connection().execute(
+        "SELECT COUNT(DISTINCT trip_id) FROM trip_events WHERE status = 'accepted'"
+    ).fetchone()[0]
+    matching_seconds = phases["request"] + phases["respond"]
+    result = {
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "params": {"drivers": args.drivers, "passengers": args.passengers, "concurrency": args.concurrency,
+                   "reject_ratio": args.reject_ratio, "seed": args.seed, "dispatch_mode": main.DISPATCH_MODE,
+                   "offer_mode": main.OFFER_MODE},
+        "updates": bench.updates,
+        "latency_ms": {
+            "p50": percentile(all_latencies, 50) * 1000,
+            "p95": percentile(all_latencies, 95) * 1000,
+            "p99": percentile(all_latencies, 99) * 1000
+        },
+        "phase_latency_ms": {phase: {"p50": percentile(v, 50) * 1000, "p95": percentile(v, 95) * 1000, "p99": percentile(v, 99) * 1000}
+                             for phase, v in bench.latencies.items()},
+        "phase_seconds": phases,
+        "offers_sent": len(offers),
+        "trips_matched": matched,
+        "trips_completed": len(rating_chats),
+        "trips_matched_per_second": matched / matching_seconds if matching_seconds else 0,
+        "db_statements_per_update": statements / bench.updates if bench.updates else 0,
+        "messages_sent": len(api.sent),
+        "peak_threads": sampler.peak_threads,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+    return result
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="offline benchmark against a fake Telegram Bot API")
+    parser.add_argument("--drivers", type=int, default=200)
+    parser.add_argument("--passengers", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--reject-ratio", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="bench_output.txt")
+    args = parser.parse_args()
+
+    # قاعدة بيانات مؤقتة وتوكن وهمي؛ حدود الإرسال مرتفعة لأن الخادم محلي
+    os.environ.setdefault("TELEGRAM_API_TOKEN", "123456:BENCHMARK")
+    os.environ["DATABASE_NAME"] = os.path.join(tempfile.mkdtemp(prefix="bot-bench-"), "bench.sqlite3")
+    os.environ["DB_TRACE"] = "1"
+    os.environ.setdefault("SEND_GLOBAL_RATE", "100000")
+    os.environ.setdefault("SEND_CHAT_RATE", "100000")
+    os.environ.setdefault("SEND_CHAT_BURST", "100000")
+    os.environ.setdefault("SEND_WORKERS", "16")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    result = run(args)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,19 @@
+import os
+import tempfile
+
+import pytest
+
+# main يقرأ الإعدادات عند الاستيراد: قاعدة بيانات مؤقتة قبل أي import main (التوكن غير مطلوب)
+os.environ["DATABASE_NAME"] = os.path.join(tempfile.mkdtemp(prefix="bot-test-"), "bot.sqlite3")
+
+import main
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    # قاعدة جديدة لكل اختبار؛ الاتصالات القديمة تُغلق حتى لا تشير للملف السابق
+    monkeypatch.setattr(main, "DATABASE_NAME", str(tmp_path / "bot.sqlite3"))
+    main.close_db_connections()
+    main.initialize_db()
+    yield main.db_connection()
+    main.close_db_connections()
@@ -6,386 +6,2439 @@ import threading
 import random
 import time
 import sqlite3
+import numpy as np
+import heapq
+import bisect
+import re
+import functools
+import sys
+from urllib.parse import urlsplit, parse_qs
+import json
+import csv
+import hmac
+import io
+import ssl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 
 from dotenv import load_dotenv
 load_dotenv()
 
 API_TOKEN = os.environ.get("TELEGRAM_API_TOKEN")
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "/Ibrahim2189/ly")
-DATABASE_NAME = "bot_db.sqlite3"
+DATABASE_NAME = os.environ.get("DATABASE_NAME", "bot_db.sqlite3")
+# حجم خلية الشبكة (بالدرجات) في الفهرس المكاني للسائقين
+GRID_CELL_DEG = float(os.environ.get("GRID_CELL_DEG", "0.01"))
+# أقصى مسافة (كم) للبحث عن سائق (بدون حد افتراضيًا)
+MAX_PICKUP_KM = float(os.environ.get("MAX_PICKUP_KM", "inf"))
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEG = math.pi * EARTH_RADIUS_KM / 180
+# إعدادات اتصال SQLite
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHED_STATEMENTS = int(os.environ.get("DB_CACHED_STATEMENTS", "256"))
+# عدّ جمل SQL المنفذة (لأداة القياس)
+DB_TRACE = os.environ.get("DB_TRACE", "0") == "1"
+# كاش المستخدمين
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "60"))
+# تحديث مواقع السائقين
+GPS_UPDATE_INTERVAL = float(os.environ.get("GPS_UPDATE_INTERVAL", "5"))
+GPS_TICK_SLACK = float(os.environ.get("GPS_TICK_SLACK", "0.5"))
+# المواقع الحية: فترة الكتابة المجمعة إلى القاعدة، وبعد كم ثانية بدون تحديث يخرج السائق من المطابقة
+LIVE_FLUSH_INTERVAL = float(os.environ.get("LIVE_FLUSH_INTERVAL", "2"))
+LIVE_STALE_AFTER = float(os.environ.get("LIVE_STALE_AFTER", "120"))
+# حفظ كل تقييم في سجل التقييمات الخام (إضافة فقط)
+RATINGS_LOG = os.environ.get("RATINGS_LOG", "1") == "1"
+# طريقة استقبال التحديثات: polling أو webhook
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+# الرابط العام الذي يرسل إليه تيليجرام (إن كان فارغًا لا يتم تسجيل الـ webhook، مفيد للاختبار المحلي)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_SSL_CERT = os.environ.get("WEBHOOK_SSL_CERT", "")
+WEBHOOK_SSL_KEY = os.environ.get("WEBHOOK_SSL_KEY", "")
+# مجدول التحديثات (polling و webhook): عدد الخيوط، حد الطابور، ونسبة امتلائه التي يبدأ عندها رفض تحديثات القوائم
+# (WEBHOOK_WORKERS و WEBHOOK_QUEUE_SIZE القديمان ما زالا مقبولين)
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", os.environ.get("WEBHOOK_WORKERS", "8")))
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", os.environ.get("WEBHOOK_QUEUE_SIZE", "1000")))
+UPDATE_SHED_AT = float(os.environ.get("UPDATE_SHED_AT", "0.8"))
+# طابور الرسائل الصادرة وحدود تيليجرام (رسالة/ثانية لكل محادثة، 30 رسالة/ثانية إجمالًا)
+SEND_WORKERS = int(os.environ.get("SEND_WORKERS", "4"))
+SEND_GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.environ.get("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = float(os.environ.get("SEND_CHAT_BURST", "3"))
+SEND_MAX_RETRIES = int(os.environ.get("SEND_MAX_RETRIES", "5"))
+# توزيع الرحلات: realtime (رحلة رحلة عند الطلب) أو batch (تجميع الرحلات كل نافذة ومطابقتها معًا)
+DISPATCH_MODE = os.environ.get("DISPATCH_MODE", "realtime")
+DISPATCH_WINDOW = float(os.environ.get("DISPATCH_WINDOW", "1.5"))
+# عدد السائقين المرشحين لكل رحلة في مصفوفة المسافات
+DISPATCH_CANDIDATES = int(os.environ.get("DISPATCH_CANDIDATES", "20"))
+# فوق هذا الحجم نستخدم الطريقة الجشعة بدل الخوارزمية المجرية
+HUNGARIAN_MAX = int(os.environ.get("HUNGARIAN_MAX", "150"))
+MIN_DRIVER_BALANCE = 2
+# مخزن حالة المحادثات: sqlite (مشترك بين عدة عمليات) أو memory
+CONVERSATION_BACKEND = os.environ.get("CONVERSATION_BACKEND", "sqlite")
+# المحادثات الأقدم من هذا (بالثواني) تعتبر منتهية
+CONVERSATION_TTL = float(os.environ.get("CONVERSATION_TTL", "86400"))
+# نقطة القياسات بصيغة Prometheus (0 = معطلة)
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+PROFILER_INTERVAL = float(os.environ.get("PROFILER_INTERVAL", "0.005"))
+# عمولة كل رحلة، وفترة لقطات الأرصدة (بالثواني، 0 = معطلة)
+TRIP_COMMISSION = float(os.environ.get("TRIP_COMMISSION", "2"))
+BALANCE_SNAPSHOT_INTERVAL = float(os.environ.get("BALANCE_SNAPSHOT_INTERVAL", "3600"))
+# إحصائيات المناطق: حجم المنطقة (بالدرجات)، طول النافذة المنزلقة وطول كل شريحة منها (بالثواني)
+ZONE_CELL_DEG = float(os.environ.get("ZONE_CELL_DEG", "0.05"))
+ZONE_WINDOW = float(os.environ.get("ZONE_WINDOW", "900"))
+ZONE_BUCKET_SECONDS = float(os.environ.get("ZONE_BUCKET_SECONDS", "60"))
+# منطقة قليلة العرض (طلبات النافذة > سائقيها × النسبة، أو بلا سائقين): البحث يتوسع بهذا المعامل
+ZONE_DEMAND_RATIO = float(os.environ.get("ZONE_DEMAND_RATIO", "2"))
+ZONE_WIDEN_FACTOR = float(os.environ.get("ZONE_WIDEN_FACTOR", "2"))
+# عدد صفوف كل دفعة عند تصدير أرشيف الرحلات، والتوكن المطلوب لتصديره (فارغ = التصدير معطل)
+EXPORT_CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", "500"))
+EXPORT_TOKEN = os.environ.get("EXPORT_TOKEN", "")
+# مهلة رد السائق على العرض (بالثواني)، وعدد المرشحين المرتبين المحفوظين لكل رحلة
+OFFER_TIMEOUT = float(os.environ.get("OFFER_TIMEOUT", "30"))
+OFFER_CANDIDATES = int(os.environ.get("OFFER_CANDIDATES", "10"))
+# sequential (سائق واحد في كل مرة) أو fanout (أقرب OFFER_FANOUT سائقين معًا، وأول من يقبل يفوز)
+OFFER_MODE = os.environ.get("OFFER_MODE", "sequential")
+OFFER_FANOUT = int(os.environ.get("OFFER_FANOUT", "3"))
+
+# =================== القياسات ===================
+# مؤقتات وعدادات خفيفة (توزيعات histogram وليس متوسطات فقط) تُعرض بصيغة Prometheus
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.help = {}
+
+    def histogram(self, metric, buckets=LATENCY_BUCKETS, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            with self.lock:
+                hist = self.histograms.setdefault(key, Histogram(buckets))
+        return hist
+
+    def inc(self, metric, value=1, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, func, help_text=""):
+        # تُحسب القيمة عند القراءة فقط؛ func ترجع رقمًا أو {labels_tuple: رقم}
+        self.gauges[name] = func
+        if help_text:
+            self.help[name] = help_text
+
+    def render(self):
+        lines = []
+
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in pairs) + "}"
+
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        typed = set()
+        for (name, labels), hist in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            with hist.lock:
+                counts, total, count = list(hist.counts), hist.sum, hist.count
+            cumulative = 0
+            for bound, n in zip(hist.buckets, counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{fmt(labels)} {total}")
+            lines.append(f"{name}_count{fmt(labels)} {count}")
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{fmt(labels)} {value}")
+        for name, func in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                continue
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            if isinstance(value, dict):
+                for labels, v in sorted(value.items()):
+                    lines.append(f"{name}{fmt(labels)} {v}")
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+def instrumented(metric, name=None, label="name"):
+    # يقيس زمن الدالة في histogram باسم metric وعلامة label=name
+    def decorator(func):
+        labels = {label: name or func.__name__}
+        hist = metrics.histogram(metric, **labels)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                metrics.inc(metric.replace("_seconds", "_errors_total"), **labels)
+                raise
+            finally:
+                hist.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+class SamplingProfiler:
+    # يأخذ عينات من مكدسات كل الخيوط على فترات ثابتة؛ يمكن تشغيله وإيقافه أثناء العمل
+    def __init__(self, interval=PROFILER_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.samples = {}
+        # لكل تشغيل حدث إيقاف خاص: خيط تشغيل سابق لا يعود للعمل إن أُعيد التشغيل قبل أن يستيقظ
+        self.stopped = None
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.stopped is not None and not self.stopped.is_set()
+
+    def start(self, interval=None):
+        with self.lock:
+            if self.running:
+                return False
+            self.interval = interval or self.interval
+            self.samples = {}
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self._run, args=(self.stopped, self.samples, self.interval),
+                                           name="sampling-profiler", daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        with self.lock:
+            if self.stopped is not None:
+                self.stopped.set()
+
+    def _run(self, stopped, samples, interval):
+        me = threading.get_ident()
+        while not stopped.is_set():
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                with self.lock:
+                    samples[key] = samples.get(key, 0) + 1
+            stopped.wait(interval)
+
+    def report(self, limit=200):
+        # صيغة collapsed stacks (متوافقة مع flamegraph.pl)
+        with self.lock:
+            top = sorted(self.samples.items(), key=lambda item: -item[1])[:limit]
+        return "".join(f"{stack} {count}\n" for stack, count in top)
+
+profiler = SamplingProfiler()
+
+# =================== اتصالات قاعدة البيانات ===================
+# اتصال واحد طويل العمر لكل خيط (WAL + busy_timeout) بدل فتح اتصال جديد لكل استعلام
+
+_db_local = threading.local()
+_db_connections = []
+_db_connections_lock = threading.Lock()
+_db_generation = 0
+db_statements = 0
+db_commit_seconds = metrics.histogram("bot_db_commit_seconds")
+
+def _count_statement(statement):
+    global db_statements
+    db_statements += 1
+
+def open_db_connection():
+    # اتصال جديد بإعدادات البوت؛ من يفتحه خارج db_connection مسؤول عن إغلاقه
+    conn = sqlite3.connect(
+        DATABASE_NAME,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,
+        cached_statements=DB_CACHED_STATEMENTS,
+        check_same_thread=False
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    if DB_TRACE:
+        conn.set_trace_callback(_count_statement)
+    return conn
+
+def _close_own_connection():
+    conn = _db_local.conn
+    _db_local.conn = None
+    with _db_connections_lock:
+        _db_connections.remove(conn)
+    conn.close()
 
-# إعداد قاعدة البيانات وإنشاء الجداول إذا لم تكن موجودة
 def db_connection():
-    return sqlite3.connect(DATABASE_NAME)
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None and _db_local.generation != _db_generation and _db_local.depth == 0:
+        # اتصال قديم بعد close_db_connections: صاحبه فقط يغلقه (إغلاقه من خيط آخر أثناء استعلام ينهي العملية)
+        _close_own_connection()
+        conn = None
+    if conn is None:
+        conn = open_db_connection()
+        _db_local.conn = conn
+        _db_local.depth = 0
+        _db_local.after_commit = []
+        _db_local.generation = _db_generation
+        with _db_connections_lock:
+            _db_connections.append(conn)
+    return conn
 
-def initialize_db():
+@contextmanager
+def db_transaction():
+    # معاملة واحدة تُثبّت مرة واحدة؛ المعاملات المتداخلة تنضم للمعاملة الخارجية
     conn = db_connection()
-    cursor = conn.cursor()
-    # جدول المستخدمين
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        telegram_id INTEGER PRIMARY KEY,
-        username TEXT,
-        role TEXT,
-        gender TEXT,
-        balance REAL DEFAULT 0,
-        ratings TEXT DEFAULT '',
-        admin INTEGER DEFAULT 0
-    )
+    if _db_local.depth == 0:
+        conn.execute("BEGIN IMMEDIATE")
+    _db_local.depth += 1
+    try:
+        yield conn
+    except BaseException:
+        _db_local.depth -= 1
+        if _db_local.depth == 0:
+            _db_local.after_commit.clear()
+            conn.execute("ROLLBACK")
+        raise
+    _db_local.depth -= 1
+    if _db_local.depth == 0:
+        started = time.perf_counter()
+        conn.execute("COMMIT")
+        db_commit_seconds.observe(time.perf_counter() - started)
+        callbacks, _db_local.after_commit = _db_local.after_commit, []
+        for func, args in callbacks:
+            try:
+                func(*args)
+            except Exception:
+                telebot.logger.exception("after-commit callback failed")
+
+def after_commit(func, *args):
+    # تحديث الذاكرة (الكاش، الفهرس) بعد تثبيت المعاملة الخارجية فقط؛ التراجع يلغيه
+    if getattr(_db_local, "depth", 0):
+        _db_local.after_commit.append((func, args))
+    else:
+        func(*args)
+
+def close_db_connections():
+    # تغلق اتصال هذا الخيط، واتصالات الخيوط الأخرى يغلقها كل خيط عند استعلامه التالي ثم يفتح اتصالًا جديدًا
+    global _db_generation
+    with _db_connections_lock:
+        _db_generation += 1
+    if getattr(_db_local, "conn", None) is not None and _db_local.depth == 0:
+        _close_own_connection()
+
+# إعداد قاعدة البيانات وإنشاء الجداول إذا لم تكن موجودة
+def initialize_db():
+    with db_transaction() as cursor:
+        # جدول المستخدمين
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id INTEGER PRIMARY KEY,
+            username TEXT,
+            role TEXT,
+            gender TEXT,
+            balance REAL DEFAULT 0,
+            ratings TEXT DEFAULT '',
+            admin INTEGER DEFAULT 0
+        )
+        """)
+        # حالة السائق
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS driver_status (
+            driver_id INTEGER PRIMARY KEY,
+            status TEXT,
+            lat REAL,
+            lon REAL
+        )
+        """)
+        # الرحلات
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS trips (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            passenger_id INTEGER,
+            passenger_name TEXT,
+            gender TEXT,
+            start_lat REAL,
+            start_lon REAL,
+            destination TEXT,
+            price REAL,
+            driver_id INTEGER
+        )
+        """)
+        # مجموع تقييمات كل سائق (عدد، مجموع، وتوزيع النجوم 1-5)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS driver_ratings (
+            driver_id INTEGER PRIMARY KEY,
+            count INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            stars_1 INTEGER DEFAULT 0,
+            stars_2 INTEGER DEFAULT 0,
+            stars_3 INTEGER DEFAULT 0,
+            stars_4 INTEGER DEFAULT 0,
+            stars_5 INTEGER DEFAULT 0
+        )
+        """)
+        # سجل التقييمات الخام
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS rating_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            driver_id INTEGER,
+            rating INTEGER,
+            created_at REAL
+        )
+        """)
+        # الترحيلات المطبقة على قاعدة البيانات
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at REAL
+        )
+        """)
+    run_migrations()
+
+# =================== ترحيلات قاعدة البيانات ===================
+# كل ترحيل يطبق مرة واحدة بالترتيب ويسجل رقمه في schema_migrations
+
+def migrate_ratings_csv(conn):
+    # نقل عمود users.ratings القديم (نص مفصول بفواصل) إلى driver_ratings ثم تفريغه
+    rows = conn.execute("SELECT telegram_id, ratings FROM users WHERE ratings IS NOT NULL AND ratings != ''").fetchall()
+    for driver_id, ratings_csv in rows:
+        ratings = [int(r) for r in ratings_csv.split(',') if r.strip() and 1 <= int(r) <= 5]
+        histogram = [ratings.count(star) for star in range(1, 6)]
+        conn.execute("""
+            INSERT INTO driver_ratings (driver_id, count, total, stars_1, stars_2, stars_3, stars_4, stars_5)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(driver_id) DO UPDATE SET
+                count = count + excluded.count,
+                total = total + excluded.total,
+                stars_1 = stars_1 + excluded.stars_1,
+                stars_2 = stars_2 + excluded.stars_2,
+                stars_3 = stars_3 + excluded.stars_3,
+                stars_4 = stars_4 + excluded.stars_4,
+                stars_5 = stars_5 + excluded.stars_5
+        """, (driver_id, len(ratings), sum(ratings), *histogram))
+        if RATINGS_LOG:
+            conn.executemany(
+                "INSERT INTO rating_log (driver_id, rating, created_at) VALUES (?, ?, NULL)",
+                [(driver_id, rating) for rating in ratings]
+            )
+        conn.execute("UPDATE users SET ratings = '' WHERE telegram_id = ?", (driver_id,))
+
+def migrate_trip_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trips_driver_id ON trips(driver_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trips_passenger_id ON trips(passenger_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_driver_status_status ON driver_status(status)")
+
+def migrate_username_lower_index(conn):
+    # فهرس تعبيري يخدم get_user_by_username (WHERE LOWER(username) = ?)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(LOWER(username))")
+
+def migrate_available_drivers_index(conn):
+    # فهرس جزئي على السائقين المتوفرين فقط
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_driver_status_available
+        ON driver_status(driver_id, lat, lon) WHERE status = 'متوفر'
     """)
-    # حالة السائق
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS driver_status (
-        driver_id INTEGER PRIMARY KEY,
-        status TEXT,
-        lat REAL,
-        lon REAL
-    )
+
+def migrate_conversation_state(conn):
+    # الخطوة التالية لكل محادثة وبياناتها (JSON)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_state (
+            chat_id INTEGER PRIMARY KEY,
+            step TEXT,
+            data TEXT,
+            updated_at REAL
+        )
     """)
-    # الرحلات
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS trips (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        passenger_id INTEGER,
-        passenger_name TEXT,
-        gender TEXT,
-        start_lat REAL,
-        start_lon REAL,
-        destination TEXT,
-        price REAL,
-        driver_id INTEGER
-    )
+
+def migrate_balance_ledger(conn):
+    # دفتر حركات الرصيد (إضافة فقط) ولقطات دورية للأرصدة
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount REAL,
+            reason TEXT,
+            balance_after REAL,
+            created_at REAL
+        )
     """)
-    conn.commit()
-    conn.close()
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_balance_ledger_user ON balance_ledger(user_id, id)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS balance_snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            balance REAL,
+            ledger_id INTEGER,
+            created_at REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_balance_snapshots_user ON balance_snapshots(user_id, id)")
+
+def migrate_trip_history(conn):
+    # الرحلات المنتهية أو الملغاة تنتقل من trips إلى أرشيف (إضافة فقط) مع سجل لكل تغيير حالة
+    conn.execute("ALTER TABLE trips ADD COLUMN requested_at REAL")
+    conn.execute("ALTER TABLE trips ADD COLUMN accepted_at REAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS trip_history (
+            id INTEGER PRIMARY KEY,
+            passenger_id INTEGER,
+            passenger_name TEXT,
+            gender TEXT,
+            start_lat REAL,
+            start_lon REAL,
+            destination TEXT,
+            price REAL,
+            driver_id INTEGER,
+            status TEXT,
+            requested_at REAL,
+            accepted_at REAL,
+            finished_at REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trip_history_finished ON trip_history(finished_at)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS trip_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            trip_id INTEGER,
+            status TEXT,
+            driver_id INTEGER,
+            created_at REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trip_events_trip ON trip_events(trip_id, id)")
+
+def migrate_trip_offers(conn):
+    # العروض في قاعدة البيانات حتى يراها أي عامل وتبقى بعد إعادة التشغيل؛ صف واحد لكل (رحلة، سائق)
+    # فلا يُعرض على نفس السائق مرتين
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS trip_offers (
+            trip_id INTEGER,
+            driver_id INTEGER,
+            status TEXT,
+            expires_at REAL,
+            PRIMARY KEY (trip_id, driver_id)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trip_offers_driver_open ON trip_offers(driver_id) WHERE status = 'open'")
+
+def migrate_available_drivers_lookup(conn):
+    # idx_driver_status_status كان يسبق الفهرس الجزئي في كل استعلامات "متوفر" فلا يُستخدم الأخير؛
+    # الفهرس الجزئي يبدأ بـ status ويغطي driver_id, lat, lon فيخدمها وحده
+    conn.execute("DROP INDEX IF EXISTS idx_driver_status_status")
+    conn.execute("DROP INDEX IF EXISTS idx_driver_status_available")
+    conn.execute("""
+        CREATE INDEX idx_driver_status_available
+        ON driver_status(status, driver_id, lat, lon) WHERE status = 'متوفر'
+    """)
+
+MIGRATIONS = [
+    (1, "ratings_csv_to_aggregates", migrate_ratings_csv),
+    (2, "trip_and_status_indexes", migrate_trip_indexes),
+    (3, "username_lower_index", migrate_username_lower_index),
+    (4, "available_drivers_partial_index", migrate_available_drivers_index),
+    (5, "conversation_state", migrate_conversation_state),
+    (6, "balance_ledger", migrate_balance_ledger),
+    (7, "trip_history", migrate_trip_history),
+    (8, "available_drivers_lookup_index", migrate_available_drivers_lookup),
+    (9, "trip_offers", migrate_trip_offers),
+]
+
+def get_schema_version():
+    row = db_connection().execute("SELECT MAX(version) FROM schema_migrations").fetchone()
+    return row[0] or 0
+
+def run_migrations():
+    with db_transaction() as conn:
+        applied = {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+        for version, name, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            migrate(conn)
+            conn.execute(
+                "INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, time.time())
+            )
+    return get_schema_version()
+
+
+class Bot(telebot.TeleBot):
+    # عند تشغيل مجدول التحديثات تمر كل التحديثات (polling أو webhook) عبره بدل المعالجة المباشرة
+    scheduler = None
+
+    def process_new_updates(self, updates):
+        if self.scheduler is None:
+            return super().process_new_updates(updates)
+        for update in updates:
+            self.scheduler.submit(update)
+
+    def process_now(self, updates):
+        super().process_new_updates(updates)
+
+# توكن بديل حتى يمكن استيراد الملف (الاختبارات وأداة القياس) بدون TELEGRAM_API_TOKEN؛ run_bot يرفض التشغيل به
+bot = Bot(API_TOKEN or "0:unset")
 
-initialize_db()
+# =================== كاش المستخدمين ===================
 
-bot = telebot.TeleBot(API_TOKEN)
+_MISSING = object()
+
+class UserCache:
+    # كاش LRU محدود الحجم مع TTL أمام get_user / get_user_by_username
+    def __init__(self, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.usernames = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, telegram_id):
+        # يرجع نسخة من المستخدم، أو None لمستخدم غير مسجل، أو _MISSING إن لم يكن في الكاش
+        with self.lock:
+            entry = self.entries.get(telegram_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._drop(telegram_id)
+                self.misses += 1
+                return _MISSING
+            self.entries.move_to_end(telegram_id)
+            self.hits += 1
+            return dict(entry[1]) if entry[1] else None
+
+    def get_id_by_username(self, username):
+        with self.lock:
+            return self.usernames.get(username)
+
+    def put(self, telegram_id, user):
+        with self.lock:
+            self._drop(telegram_id)
+            self.entries[telegram_id] = (time.monotonic() + self.ttl, user)
+            if user and user["username"]:
+                self.usernames[user["username"].lower()] = telegram_id
+            while len(self.entries) > self.maxsize:
+                oldest = next(iter(self.entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def update(self, telegram_id, field, value):
+        with self.lock:
+            entry = self.entries.get(telegram_id)
+            if entry and entry[1]:
+                entry[1][field] = value
+
+    def invalidate(self, telegram_id):
+        with self.lock:
+            self._drop(telegram_id)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.usernames.clear()
+
+    def _drop(self, telegram_id):
+        entry = self.entries.pop(telegram_id, None)
+        if entry and entry[1] and entry[1]["username"]:
+            username = entry[1]["username"].lower()
+            if self.usernames.get(username) == telegram_id:
+                del self.usernames[username]
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / total if total else 0.0
+            }
+
+user_cache = UserCache()
 
 # =================== وظائف مساعدة ===================
 
+def user_from_row(row):
+    return {
+        "telegram_id": row[0],
+        "username": row[1],
+        "role": row[2],
+        "gender": row[3],
+        "balance": row[4],
+        "admin": bool(row[5])
+    }
+
+@instrumented("bot_db_seconds", label="query")
 def get_user(telegram_id):
-    conn = db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT telegram_id, username, role, gender, balance, ratings, admin FROM users WHERE telegram_id = ?", (telegram_id,))
-    row = cur.fetchone()
-    conn.close()
-    if row:
-        ratings = list(map(int, filter(None, row[5].split(','))))
-        return {
-            "telegram_id": row[0],
-            "username": row[1],
-            "role": row[2],
-            "gender": row[3],
-            "balance": row[4],
-            "ratings": ratings,
-            "admin": bool(row[6])
-        }
-    return None
+    user = user_cache.get(telegram_id)
+    if user is not _MISSING:
+        return user
+    row = db_connection().execute(
+        "SELECT telegram_id, username, role, gender, balance, admin FROM users WHERE telegram_id = ?", (telegram_id,)
+    ).fetchone()
+    user = user_from_row(row) if row else None
+    user_cache.put(telegram_id, user)
+    return dict(user) if user else None
 
+@instrumented("bot_db_seconds", label="query")
 def set_user(telegram_id, username, role, gender=None, balance=0, admin=0):
-    conn = db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT OR REPLACE INTO users (telegram_id, username, role, gender, balance, admin)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (telegram_id, username, role, gender, balance, admin))
-    conn.commit()
-    conn.close()
+    with db_transaction() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO users (telegram_id, username, role, gender, balance, admin)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (telegram_id, username, role, gender, balance, admin))
+    user_cache.put(telegram_id, {
+        "telegram_id": telegram_id,
+        "username": username,
+        "role": role,
+        "gender": gender,
+        "balance": balance,
+        "admin": bool(admin)
+    })
+    driver_index.update_profile(telegram_id, gender=gender, balance=balance)
 
+@instrumented("bot_db_seconds", label="query")
 def update_user_field(telegram_id, field, value):
-    conn = db_connection()
-    cur = conn.cursor()
-    cur.execute(f"UPDATE users SET {field} = ? WHERE telegram_id = ?", (value, telegram_id))
-    conn.commit()
-    conn.close()
+    with db_transaction() as conn:
+        conn.execute(f"UPDATE users SET {field} = ? WHERE telegram_id = ?", (value, telegram_id))
+    if field == "admin":
+        user_cache.update(telegram_id, field, bool(value))
+    elif field == "username":
+        user_cache.invalidate(telegram_id)
+    else:
+        user_cache.update(telegram_id, field, value)
+    if field in ("gender", "balance"):
+        driver_index.update_profile(telegram_id, **{field: value})
 
+@instrumented("bot_db_seconds", label="query")
 def add_rating(driver_id, rating):
-    user = get_user(driver_id)
-    ratings = user["ratings"] if user else []
-    ratings.append(rating)
-    update_user_field(driver_id, "ratings", ",".join(map(str, ratings)))
+    # تحديث ذري للمجموع داخل SQL بدل قراءة كل التقييمات وإعادة كتابتها
+    rating = int(rating)
+    if rating < 1 or rating > 5:
+        raise ValueError(rating)
+    column = f"stars_{rating}"
+    with db_transaction() as conn:
+        conn.execute(f"""
+            INSERT INTO driver_ratings (driver_id, count, total, {column}) VALUES (?, 1, ?, 1)
+            ON CONFLICT(driver_id) DO UPDATE SET
+                count = count + 1,
+                total = total + excluded.total,
+                {column} = {column} + 1
+        """, (driver_id, rating))
+        if RATINGS_LOG:
+            conn.execute("INSERT INTO rating_log (driver_id, rating, created_at) VALUES (?, ?, ?)", (driver_id, rating, time.time()))
 
+@instrumented("bot_db_seconds", label="query")
+def get_rating_summary(driver_id):
+    row = db_connection().execute(
+        "SELECT count, total, stars_1, stars_2, stars_3, stars_4, stars_5 FROM driver_ratings WHERE driver_id = ?", (driver_id,)
+    ).fetchone()
+    if not row or not row[0]:
+        return {"count": 0, "average": 0, "histogram": [0, 0, 0, 0, 0]}
+    return {"count": row[0], "average": row[1] / row[0], "histogram": list(row[2:])}
+
+@instrumented("bot_db_seconds", label="query")
 def get_driver_status(driver_id):
-    conn = db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT status, lat, lon FROM driver_status WHERE driver_id = ?", (driver_id,))
-    row = cur.fetchone()
-    conn.close()
+    row = db_connection().execute("SELECT status, lat, lon FROM driver_status WHERE driver_id = ?", (driver_id,)).fetchone()
     if row:
         return {"status": row[0], "location": (row[1], row[2])}
     return None
 
+@instrumented("bot_db_seconds", label="query")
 def set_driver_status(driver_id, status, lat=None, lon=None):
-    conn = db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT OR REPLACE INTO driver_status (driver_id, status, lat, lon)
-        VALUES (?, ?, ?, ?)
-    """, (driver_id, status, lat, lon))
-    conn.commit()
-    conn.close()
+    with db_transaction() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO driver_status (driver_id, status, lat, lon)
+            VALUES (?, ?, ?, ?)
+        """, (driver_id, status, lat, lon))
+    if status == 'متوفر' and lat is not None and lon is not None:
+        if not driver_index.move(driver_id, lat, lon):
+            user = get_user(driver_id)
+            if user:
+                driver_index.upsert(driver_id, lat, lon, user["gender"], user["balance"])
+    else:
+        driver_index.remove(driver_id)
+        gps_scheduler.discard(driver_id)
+        live_locations.discard(driver_id)
 
+@instrumented("bot_db_seconds", label="query")
 def get_all_available_drivers(gender, min_balance):
-    conn = db_connection()
-    cur = conn.cursor()
-    cur.execute("""
+    return db_connection().execute("""
         SELECT d.driver_id, d.lat, d.lon FROM driver_status d
         JOIN users u ON d.driver_id = u.telegram_id
         WHERE d.status = 'متوفر' AND u.gender = ? AND u.balance >= ?
-    """, (gender, min_balance))
-    drivers = cur.fetchall()
-    conn.close()
-    return drivers
+    """, (gender, min_balance)).fetchall()
 
+@instrumented("bot_db_seconds", label="query")
 def get_trip_for_driver(driver_id):
-    conn = db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, passenger_id FROM trips WHERE driver_id = ?", (driver_id,))
-    row = cur.fetchone()
-    conn.close()
+    row = db_connection().execute("SELECT id, passenger_id FROM trips WHERE driver_id = ?", (driver_id,)).fetchone()
     if row:
         return {"trip_id": row[0], "passenger_id": row[1]}
     return None
 
-def remove_trip(trip_id):
-    conn = db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM trips WHERE id = ?", (trip_id,))
-    conn.commit()
-    conn.close()
+@instrumented("bot_db_seconds", label="query")
+def get_trip(trip_id):
+    row = db_connection().execute("""
+        SELECT id, passenger_id, passenger_name, gender, start_lat, start_lon, destination, price, driver_id
+        FROM trips WHERE id = ?
+    """, (trip_id,)).fetchone()
+    if row:
+        return {"trip_id": row[0], "passenger_id": row[1], "passenger_name": row[2], "gender": row[3],
+                "start": (row[4], row[5]), "destination": row[6], "price": row[7], "driver_id": row[8]}
+    return None
 
+@instrumented("bot_db_seconds", label="query")
 def get_trips():
-    conn = db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM trips")
-    trips = cur.fetchall()
-    conn.close()
-    return trips
+    return db_connection().execute("SELECT * FROM trips").fetchall()
 
+@instrumented("bot_db_seconds", label="query")
 def get_trip_by_passenger(passenger_id):
-    conn = db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM trips WHERE passenger_id = ?", (passenger_id,))
-    trip = cur.fetchone()
-    conn.close()
-    return trip
+    return db_connection().execute("SELECT * FROM trips WHERE passenger_id = ?", (passenger_id,)).fetchone()
 
+@instrumented("bot_db_seconds", label="query")
 def add_trip(trip):
-    conn = db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO trips (passenger_id, passenger_name, gender, start_lat, start_lon, destination, price, driver_id)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        trip["passenger_id"], trip["passenger_name"], trip["gender"],
-        trip["start"][0], trip["start"][1], trip["destination"], trip["price"], trip.get("driver_id")
-    ))
-    conn.commit()
-    conn.close()
+    now = time.time()
+    with db_transaction() as conn:
+        cursor = conn.execute("""
+            INSERT INTO trips (passenger_id, passenger_name, gender, start_lat, start_lon, destination, price, driver_id, requested_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            trip["passenger_id"], trip["passenger_name"], trip["gender"],
+            trip["start"][0], trip["start"][1], trip["destination"], trip["price"], trip.get("driver_id"), now
+        ))
+        conn.execute("INSERT INTO trip_events (trip_id, status, driver_id, created_at) VALUES (?, 'requested', NULL, ?)", (cursor.lastrowid, now))
+        return cursor.lastrowid
 
+@instrumented("bot_db_seconds", label="query")
 def update_trip_driver(trip_id, driver_id):
-    conn = db_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE trips SET driver_id = ? WHERE id = ?", (driver_id, trip_id))
-    conn.commit()
-    conn.close()
+    with db_transaction() as conn:
+        conn.execute("UPDATE trips SET driver_id = ? WHERE id = ?", (driver_id, trip_id))
 
+@instrumented("bot_db_seconds", label="query")
 def get_user_by_username(username):
     username = username.lstrip('@').lower()
-    conn = db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT telegram_id, username, role, gender, balance, ratings FROM users WHERE LOWER(username) = ?", (username,))
-    row = cur.fetchone()
-    conn.close()
+    telegram_id = user_cache.get_id_by_username(username)
+    if telegram_id is not None:
+        user = get_user(telegram_id)
+        if user and (user["username"] or "").lower() == username:
+            return user
+    row = db_connection().execute(
+        "SELECT telegram_id, username, role, gender, balance, admin FROM users WHERE LOWER(username) = ?", (username,)
+    ).fetchone()
     if row:
-        ratings = list(map(int, filter(None, row[5].split(','))))
-        return {
-            "telegram_id": row[0],
-            "username": row[1],
-            "role": row[2],
-            "gender": row[3],
-            "balance": row[4],
-            "ratings": ratings
-        }
+        user = user_from_row(row)
+        user_cache.put(user["telegram_id"], user)
+        return dict(user)
     return None
 
-def distance(loc1, loc2):
-    lat1, lon1 = loc1
-    lat2, lon2 = loc2
-    return math.sqrt((lat1 - lat2) ** 2 + (lon1 - lon2) ** 2)
+# =================== دفتر الأرصدة ===================
+# كل تغيير في الرصيد = قيد في balance_ledger + زيادة ذرية داخل SQL في نفس المعاملة،
+# فلا تضيع التحديثات المتزامنة ويبقى users.balance قراءة O(1)
+
+def _apply_balance(user_id, balance):
+    # RETURNING يرجع القيمة قبل تطبيق نوع العمود (REAL)
+    balance = float(balance)
+    user_cache.update(user_id, "balance", balance)
+    driver_index.update_profile(user_id, balance=balance)
+
+@instrumented("bot_db_seconds", label="query")
+def post_ledger_entry(user_id, amount, reason):
+    # يرجع الرصيد الجديد، أو None إن لم يوجد المستخدم
+    with db_transaction() as conn:
+        row = conn.execute(
+            "UPDATE users SET balance = balance + ? WHERE telegram_id = ? RETURNING balance", (amount, user_id)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "INSERT INTO balance_ledger (user_id, amount, reason, balance_after, created_at) VALUES (?, ?, ?, ?, ?)",
+            (user_id, amount, reason, row[0], time.time())
+        )
+        after_commit(_apply_balance, user_id, row[0])
+    return float(row[0])
+
+@instrumented("bot_db_seconds", label="query")
+def post_ledger_entries(entries):
+    # entries: [(user_id, amount, reason)] تُسجل كلها في معاملة واحدة
+    balances = {}
+    now = time.time()
+    with db_transaction() as conn:
+        for user_id, amount, reason in entries:
+            row = conn.execute(
+                "UPDATE users SET balance = balance + ? WHERE telegram_id = ? RETURNING balance", (amount, user_id)
+            ).fetchone()
+            if row is None:
+                continue
+            conn.execute(
+                "INSERT INTO balance_ledger (user_id, amount, reason, balance_after, created_at) VALUES (?, ?, ?, ?, ?)",
+                (user_id, amount, reason, row[0], now)
+            )
+            balances[user_id] = float(row[0])
+        for user_id, balance in balances.items():
+            after_commit(_apply_balance, user_id, balance)
+    return balances
+
+def snapshot_balances():
+    # لقطة لرصيد كل مستخدم تغير رصيده منذ آخر لقطة
+    with db_transaction() as conn:
+        last = conn.execute("SELECT COALESCE(MAX(ledger_id), 0) FROM balance_snapshots").fetchone()[0]
+        head = conn.execute("SELECT COALESCE(MAX(id), 0) FROM balance_ledger").fetchone()[0]
+        if head == last:
+            return 0
+        cur = conn.execute("""
+            INSERT INTO balance_snapshots (user_id, balance, ledger_id, created_at)
+            SELECT telegram_id, balance, ?, ? FROM users
+            WHERE telegram_id IN (SELECT DISTINCT user_id FROM balance_ledger WHERE id > ? AND id <= ?)
+        """, (head, time.time(), last, head))
+        return cur.rowcount
+
+def audit_balance(user_id):
+    # آخر لقطة + مجموع القيود بعدها يجب أن يساوي users.balance
+    conn = db_connection()
+    snapshot = conn.execute(
+        "SELECT balance, ledger_id FROM balance_snapshots WHERE user_id = ? ORDER BY id DESC LIMIT 1", (user_id,)
+    ).fetchone()
+    base, ledger_id = snapshot if snapshot else (None, 0)
+    row = conn.execute(
+        "SELECT COALESCE(SUM(amount), 0), COUNT(*) FROM balance_ledger WHERE user_id = ? AND id > ?", (user_id, ledger_id)
+    ).fetchone()
+    actual = conn.execute("SELECT balance FROM users WHERE telegram_id = ?", (user_id,)).fetchone()
+    return {
+        "snapshot_balance": base,
+        "entries_since_snapshot": row[1],
+        "expected": None if base is None else base + row[0],
+        "actual": actual[0] if actual else None
+    }
+
+# =================== أرشيف الرحلات ===================
+# جدول trips يبقى صغيرًا (الرحلات الجارية فقط) من أجل التوزيع؛ الباقي في trip_history و trip_events
 
-def gps_update_loop(driver_id):
+TRIP_HISTORY_COLUMNS = ("id", "passenger_id", "passenger_name", "gender", "start_lat", "start_lon", "destination",
+                        "price", "driver_id", "status", "requested_at", "accepted_at", "finished_at")
+
+@instrumented("bot_db_seconds", label="query")
+def record_trip_event(trip_id, status, driver_id=None):
+    with db_transaction() as conn:
+        conn.execute("INSERT INTO trip_events (trip_id, status, driver_id, created_at) VALUES (?, ?, ?, ?)",
+                     (trip_id, status, driver_id, time.time()))
+
+@instrumented("bot_db_seconds", label="query")
+def archive_trip(trip_id, status):
+    # ينقل الرحلة إلى الأرشيف بحالتها النهائية (completed أو cancelled) ويحذفها من trips
+    now = time.time()
+    with db_transaction() as conn:
+        conn.execute("""
+            INSERT INTO trip_history (id, passenger_id, passenger_name, gender, start_lat, start_lon, destination,
+                                      price, driver_id, status, requested_at, accepted_at, finished_at)
+            SELECT id, passenger_id, passenger_name, gender, start_lat, start_lon, destination,
+                   price, driver_id, ?, requested_at, accepted_at, ?
+            FROM trips WHERE id = ?
+        """, (status, now, trip_id))
+        conn.execute("""
+            INSERT INTO trip_events (trip_id, status, driver_id, created_at)
+            SELECT id, ?, driver_id, ? FROM trips WHERE id = ?
+        """, (status, now, trip_id))
+        conn.execute("DELETE FROM trips WHERE id = ?", (trip_id,))
+        conn.execute("DELETE FROM trip_offers WHERE trip_id = ?", (trip_id,))
+
+def iter_trip_history(since=0, chunk_rows=EXPORT_CHUNK_ROWS, conn=None):
+    # دفعات بترقيم المفتاح (id > آخر id) حتى لا يبقى استعلام مفتوح ولا يكبر استهلاك الذاكرة مع حجم الأرشيف
+    conn = conn or db_connection()
+    last_id = 0
     while True:
-        status_obj = get_driver_status(driver_id)
-        if not status_obj or status_obj["status"] != "متوفر":
+        rows = conn.execute(f"""
+            SELECT {', '.join(TRIP_HISTORY_COLUMNS)} FROM trip_history
+            WHERE id > ? AND finished_at >= ? ORDER BY id LIMIT ?
+        """, (last_id, since, chunk_rows)).fetchall()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+def export_trip_history(fmt="csv", since=0, chunk_rows=EXPORT_CHUNK_ROWS, conn=None):
+    # مولد نصوص: CSV بعنوان في أول دفعة، أو JSON lines
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(TRIP_HISTORY_COLUMNS)
+        for rows in iter_trip_history(since, chunk_rows, conn):
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    elif fmt == "jsonl":
+        for rows in iter_trip_history(since, chunk_rows, conn):
+            yield "".join(json.dumps(dict(zip(TRIP_HISTORY_COLUMNS, row)), ensure_ascii=False) + "\n" for row in rows)
+    else:
+        raise ValueError(f"unknown export format: {fmt}")
+
+def distance(loc1, loc2):
+    # مسافة haversine الحقيقية بالكيلومتر
+    lat1, lon1 = map(math.radians, loc1)
+    lat2, lon2 = map(math.radians, loc2)
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+# =================== إحصائيات المناطق ===================
+# لكل منطقة شبكة حلقة ثابتة من الشرائح الزمنية: كل حدث يزيد عدادًا في الشريحة الحالية (O(1))،
+# والقراءة تجمع شرائح النافذة فقط. عدد السائقين المتوفرين يتحدث من الفهرس المكاني عند الدخول والخروج
+
+ZONE_FIELDS = {"requests": 1, "matches": 2, "rejections": 3, "unmatched": 4}
+ZONE_PRICE = 5
+
+class ZoneStats:
+    def __init__(self, cell_deg=ZONE_CELL_DEG, window=ZONE_WINDOW, bucket_seconds=ZONE_BUCKET_SECONDS):
+        self.cell_deg = cell_deg
+        self.bucket_seconds = bucket_seconds
+        self.buckets = max(1, int(math.ceil(window / bucket_seconds)))
+        self.lock = threading.Lock()
+        # المنطقة -> شرائح [رقم الشريحة، طلبات، مطابقات، رفض، بلا سائق، مجموع الأسعار]
+        self.zones = {}
+        # المنطقة -> عدد السائقين المتوفرين فيها
+        self.drivers = {}
+
+    def zone_of(self, lat, lon):
+        return (math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+
+    def record(self, loc, field, price=None):
+        epoch = int(time.time() // self.bucket_seconds)
+        zone = self.zone_of(*loc)
+        with self.lock:
+            ring = self.zones.get(zone)
+            if ring is None:
+                ring = self.zones[zone] = [[-1, 0, 0, 0, 0, 0.0] for _ in range(self.buckets)]
+            bucket = ring[epoch % self.buckets]
+            if bucket[0] != epoch:
+                bucket[:] = [epoch, 0, 0, 0, 0, 0.0]
+            bucket[ZONE_FIELDS[field]] += 1
+            if price is not None:
+                bucket[ZONE_PRICE] += price
+
+    def move_driver(self, old_zone, new_zone):
+        if old_zone == new_zone:
+            return
+        with self.lock:
+            if old_zone is not None:
+                count = self.drivers.get(old_zone, 0) - 1
+                if count > 0:
+                    self.drivers[old_zone] = count
+                else:
+                    self.drivers.pop(old_zone, None)
+            if new_zone is not None:
+                self.drivers[new_zone] = self.drivers.get(new_zone, 0) + 1
+
+    def _totals(self, zone, oldest):
+        totals = [0, 0, 0, 0, 0, 0.0]
+        for bucket in self.zones.get(zone, ()):
+            if bucket[0] >= oldest:
+                for i in range(1, len(bucket)):
+                    totals[i] += bucket[i]
+        return totals
+
+    def summary(self, zone):
+        oldest = int(time.time() // self.bucket_seconds) - self.buckets + 1
+        with self.lock:
+            totals = self._totals(zone, oldest)
+            drivers = self.drivers.get(zone, 0)
+        requests = totals[ZONE_FIELDS["requests"]]
+        result = {name: totals[i] for name, i in ZONE_FIELDS.items()}
+        result["average_price"] = totals[ZONE_PRICE] / requests if requests else 0.0
+        result["drivers"] = drivers
+        return result
+
+    def under_supplied(self, loc):
+        summary = self.summary(self.zone_of(*loc))
+        return summary["drivers"] == 0 or summary["requests"] > summary["drivers"] * ZONE_DEMAND_RATIO
+
+    def search_limits(self, loc, k, max_km=MAX_PICKUP_KM):
+        # في المناطق قليلة العرض نبحث أبعد وعن مرشحين أكثر
+        if self.under_supplied(loc):
+            metrics.inc("bot_zone_widened_searches_total")
+            return int(k * ZONE_WIDEN_FACTOR), max_km * ZONE_WIDEN_FACTOR
+        return k, max_km
+
+    def top_zones(self, limit=10):
+        # للأدمن فقط: يمر على كل المناطق، ويحذف المناطق الخاملة بلا سائقين
+        oldest = int(time.time() // self.bucket_seconds) - self.buckets + 1
+        with self.lock:
+            for zone in [z for z, ring in self.zones.items() if z not in self.drivers and all(b[0] < oldest for b in ring)]:
+                del self.zones[zone]
+            zones = set(self.zones) | set(self.drivers)
+        summaries = [(zone, self.summary(zone)) for zone in zones]
+        summaries.sort(key=lambda item: (item[1]["requests"], item[1]["drivers"]), reverse=True)
+        return summaries[:limit]
+
+    def zone_center(self, zone):
+        return ((zone[0] + 0.5) * self.cell_deg, (zone[1] + 0.5) * self.cell_deg)
+
+zone_stats = ZoneStats()
+
+# =================== الفهرس المكاني للسائقين ===================
+
+class DriverIndex:
+    # خريطة خلايا شبكة (lat/lon) -> السائقين المتوفرين، مع بحث حلقي لأقرب k سائق
+    def __init__(self, cell_deg=GRID_CELL_DEG):
+        self.cell_deg = cell_deg
+        self.lock = threading.RLock()
+        self.cells = {}
+        self.drivers = {}
+
+    def cell_of(self, lat, lon):
+        return (math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+
+    def __len__(self):
+        return len(self.drivers)
+
+    def __contains__(self, driver_id):
+        return driver_id in self.drivers
+
+    def upsert(self, driver_id, lat, lon, gender, balance):
+        with self.lock:
+            self.remove(driver_id)
+            cell = self.cell_of(lat, lon)
+            zone = zone_stats.zone_of(lat, lon)
+            self.drivers[driver_id] = {"lat": lat, "lon": lon, "gender": gender, "balance": balance, "cell": cell, "zone": zone}
+            self.cells.setdefault(cell, set()).add(driver_id)
+            zone_stats.move_driver(None, zone)
+
+    def move(self, driver_id, lat, lon):
+        with self.lock:
+            driver = self.drivers.get(driver_id)
+            if not driver:
+                return False
+            cell = self.cell_of(lat, lon)
+            if cell != driver["cell"]:
+                self._unlink(driver_id, driver["cell"])
+                self.cells.setdefault(cell, set()).add(driver_id)
+                driver["cell"] = cell
+                zone = zone_stats.zone_of(lat, lon)
+                zone_stats.move_driver(driver["zone"], zone)
+                driver["zone"] = zone
+            driver["lat"], driver["lon"] = lat, lon
+            return True
+
+    def update_profile(self, driver_id, gender=None, balance=None):
+        with self.lock:
+            driver = self.drivers.get(driver_id)
+            if not driver:
+                return
+            if gender is not None:
+                driver["gender"] = gender
+            if balance is not None:
+                driver["balance"] = float(balance)
+
+    def remove(self, driver_id):
+        with self.lock:
+            driver = self.drivers.pop(driver_id, None)
+            if driver:
+                self._unlink(driver_id, driver["cell"])
+                zone_stats.move_driver(driver["zone"], None)
+
+    def _unlink(self, driver_id, cell):
+        bucket = self.cells.get(cell)
+        if bucket is not None:
+            bucket.discard(driver_id)
+            if not bucket:
+                del self.cells[cell]
+
+    def nearest(self, loc, k=1, gender=None, min_balance=0, max_km=MAX_PICKUP_KM):
+        # يرجع قائمة [(المسافة, driver_id)] مرتبة تصاعديًا
+        lat, lon = loc
+        ci, cj = self.cell_of(lat, lon)
+        best = []
+
+        def consider(driver_id):
+            driver = self.drivers[driver_id]
+            if gender is not None and driver["gender"] != gender:
+                return
+            if driver["balance"] < min_balance:
+                return
+            d = distance((driver["lat"], driver["lon"]), loc)
+            if d > max_km:
+                return
+            if len(best) < k:
+                heapq.heappush(best, (-d, driver_id))
+            elif d < -best[0][0]:
+                heapq.heapreplace(best, (-d, driver_id))
+
+        with self.lock:
+            total = len(self.drivers)
+            seen = 0
+            ring = 0
+            while seen < total:
+                # كل سائق خارج الحلقات المفحوصة أبعد من هذا الحد
+                # (عرض الخلية بخط الطول يضيق كلما ابتعدنا عن خط الاستواء)
+                cos_lat = math.cos(math.radians(min(89.9, abs(lat) + (ring + 1) * self.cell_deg)))
+                bound = max(ring - 1, 0) * self.cell_deg * KM_PER_DEG * cos_lat
+                if bound > max_km or (len(best) == k and bound > -best[0][0]):
+                    break
+                if 8 * ring > len(self.cells):
+                    # السائقون متفرقون: فحص الخلايا المشغولة المتبقية أرخص من متابعة الحلقات
+                    for (i, j), bucket in self.cells.items():
+                        if max(abs(i - ci), abs(j - cj)) >= ring:
+                            for driver_id in bucket:
+                                consider(driver_id)
+                    break
+                for cell in self._ring_cells(ci, cj, ring):
+                    for driver_id in self.cells.get(cell, ()):
+                        seen += 1
+                        consider(driver_id)
+                ring += 1
+        return sorted((-d, driver_id) for d, driver_id in best)
+
+    @staticmethod
+    def _ring_cells(ci, cj, ring):
+        if ring == 0:
+            yield (ci, cj)
+            return
+        for j in range(cj - ring, cj + ring + 1):
+            yield (ci - ring, j)
+            yield (ci + ring, j)
+        for i in range(ci - ring + 1, ci + ring):
+            yield (i, cj - ring)
+            yield (i, cj + ring)
+
+driver_index = DriverIndex()
+
+def load_driver_index():
+    rows = db_connection().execute("""
+        SELECT d.driver_id, d.lat, d.lon, u.gender, u.balance FROM driver_status d
+        JOIN users u ON d.driver_id = u.telegram_id
+        WHERE d.status = 'متوفر' AND d.lat IS NOT NULL AND d.lon IS NOT NULL
+    """).fetchall()
+    for driver_id, lat, lon, gender, balance in rows:
+        driver_index.upsert(driver_id, lat, lon, gender, balance or 0)
+
+
+# =================== تحديث مواقع السائقين ===================
+# خيط واحد يحمل كومة (heap) بمواعيد السائقين، ويكتب كل السائقين المستحقين في معاملة واحدة
+
+SQLITE_MAX_VARS = 500
+
+class GpsScheduler:
+    def __init__(self, interval=GPS_UPDATE_INTERVAL, slack=GPS_TICK_SLACK):
+        self.interval = interval
+        self.slack = slack
+        self.cond = threading.Condition()
+        self.heap = []
+        # driver_id -> موعد مدخله الحي في الكومة؛ أي مدخل بموعد آخر قديم ويُتجاهل
+        self.active = {}
+        self.thread = None
+
+    def __len__(self):
+        return len(self.active)
+
+    def add(self, driver_id):
+        # سائق واحد = مدخل واحد مهما ضغط على الزر
+        with self.cond:
+            if driver_id in self.active:
+                return False
+            due_at = time.monotonic() + self.interval
+            self.active[driver_id] = due_at
+            heapq.heappush(self.heap, (due_at, driver_id))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="gps-scheduler", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+            return True
+
+    def discard(self, driver_id):
+        with self.cond:
+            self.active.pop(driver_id, None)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.heap:
+                    self.cond.wait()
+                due_at = self.heap[0][0]
+                now = time.monotonic()
+                if due_at > now:
+                    self.cond.wait(due_at - now)
+                    continue
+                due = []
+                while self.heap and self.heap[0][0] <= now + self.slack:
+                    entry = heapq.heappop(self.heap)
+                    if self.active.get(entry[1]) == entry[0]:
+                        due.append(entry)
+                if not due:
+                    continue
+            driver_ids = [driver_id for _, driver_id in due]
+            try:
+                still_active = self.tick(driver_ids)
+            except Exception:
+                still_active = set(driver_ids)
+            with self.cond:
+                next_at = time.monotonic() + self.interval
+                for due_at, driver_id in due:
+                    # أُزيل السائق أو أُعيدت إضافته أثناء التحديث: مدخله الجديد في الكومة أصلًا
+                    if self.active.get(driver_id) != due_at:
+                        continue
+                    if driver_id in still_active:
+                        self.active[driver_id] = next_at
+                        heapq.heappush(self.heap, (next_at, driver_id))
+                    else:
+                        del self.active[driver_id]
+
+    def tick(self, driver_ids):
+        rows = []
+        conn = db_connection()
+        for i in range(0, len(driver_ids), SQLITE_MAX_VARS):
+            chunk = driver_ids[i:i + SQLITE_MAX_VARS]
+            rows += conn.execute(
+                f"SELECT driver_id, lat, lon FROM driver_status WHERE status = 'متوفر' AND driver_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            ).fetchall()
+        updates = []
+        for driver_id, lat, lon in rows:
+            if lat is None or lon is None:
+                continue
+            lat += random.uniform(-0.0005, 0.0005)
+            lon += random.uniform(-0.0005, 0.0005)
+            updates.append((lat, lon, driver_id))
+        if updates:
+            with db_transaction() as conn:
+                conn.executemany("UPDATE driver_status SET lat = ?, lon = ? WHERE driver_id = ? AND status = 'متوفر'", updates)
+            for lat, lon, driver_id in updates:
+                driver_index.move(driver_id, lat, lon)
+        return {driver_id for _, _, driver_id in updates}
+
+gps_scheduler = GpsScheduler()
+
+# =================== المواقع الحية ===================
+# الموقع المباشر من تيليجرام يصل كتعديلات متتالية للرسالة؛ كل تحديث يغير الذاكرة والفهرس فقط،
+# والكاتب المؤجل يجمع آخر موقع لكل سائق ويكتبهم في معاملة واحدة كل LIVE_FLUSH_INTERVAL
+
+class LivePosition:
+    __slots__ = ("lat", "lon", "updated_at", "dirty")
+
+    def __init__(self, lat, lon, updated_at):
+        self.lat = lat
+        self.lon = lon
+        self.updated_at = updated_at
+        self.dirty = True
+
+class LiveLocations:
+    def __init__(self, stale_after=LIVE_STALE_AFTER):
+        self.stale_after = stale_after
+        self.lock = threading.Lock()
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, driver_id):
+        return driver_id in self.positions
+
+    def get(self, driver_id):
+        with self.lock:
+            position = self.positions.get(driver_id)
+            return (position.lat, position.lon) if position else None
+
+    def update(self, driver_id, lat, lon):
+        # False إذا لم يكن السائق متوفرًا
+        now = time.monotonic()
+        with self.lock:
+            position = self.positions.get(driver_id)
+            if position is not None:
+                position.lat, position.lon, position.updated_at, position.dirty = lat, lon, now, True
+        if position is None:
+            # أول تحديث (أو عودة بعد انقطاع): تحقق من الحالة مرة واحدة
+            status = get_driver_status(driver_id)
+            if not status or status["status"] != 'متوفر':
+                return False
+            with self.lock:
+                self.positions[driver_id] = LivePosition(lat, lon, now)
+            gps_scheduler.discard(driver_id)
+        metrics.inc("bot_live_location_updates_total")
+        if not driver_index.move(driver_id, lat, lon):
+            user = get_user(driver_id)
+            if user:
+                driver_index.upsert(driver_id, lat, lon, user["gender"], user["balance"])
+        return True
+
+    def discard(self, driver_id):
+        with self.lock:
+            self.positions.pop(driver_id, None)
+
+    @instrumented("bot_db_seconds", "live_locations_flush", "query")
+    def flush(self):
+        # يكتب المواقع المتغيرة؛ السائق الصامت يصبح مشغولًا (في القاعدة والفهرس معًا) ويُطلب منه إعادة المشاركة
+        cutoff = time.monotonic() - self.stale_after
+        with self.lock:
+            updates = []
+            for driver_id, position in self.positions.items():
+                if position.dirty:
+                    updates.append((position.lat, position.lon, driver_id))
+                    position.dirty = False
+            stale = [driver_id for driver_id, position in self.positions.items() if position.updated_at < cutoff]
+            for driver_id in stale:
+                del self.positions[driver_id]
+        stopped = []
+        if updates or stale:
+            with db_transaction() as conn:
+                conn.executemany("UPDATE driver_status SET lat = ?, lon = ? WHERE driver_id = ? AND status = 'متوفر'", updates)
+                for driver_id in stale:
+                    if conn.execute("UPDATE driver_status SET status = 'مشغول' WHERE driver_id = ? AND status = 'متوفر'",
+                                    (driver_id,)).rowcount:
+                        stopped.append(driver_id)
+        for driver_id in stale:
+            driver_index.remove(driver_id)
+        for driver_id in stopped:
+            send_message(driver_id, "⚠️ توقفت مشاركة موقعك المباشر فأصبحت مشغولًا.\nاضغط 'متوفر ✅' وشارك موقعك المباشر من جديد.", PRIORITY_TRIP)
+        if stale:
+            metrics.inc("bot_live_location_stale_total", len(stale))
+        return len(updates), len(stale)
+
+live_locations = LiveLocations()
+
+# =================== المؤقتات ===================
+# خيط واحد وكومة مواعيد لكل المهام المؤجلة (مهلة العروض، اللقطات الدورية) بدل خيط لكل مهمة
+
+class TimerService:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []
+        self.pending = set()
+        self.seq = 0
+        self.thread = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def schedule(self, delay, func, *args):
+        # يرجع رقم المؤقت لإلغائه لاحقًا
+        with self.cond:
+            self.seq += 1
+            timer_id = self.seq
+            self.pending.add(timer_id)
+            heapq.heappush(self.heap, (time.monotonic() + delay, timer_id, func, args))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="timers", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+            return timer_id
+
+    def every(self, interval, func):
+        def run():
+            try:
+                func()
+            finally:
+                self.schedule(interval, run)
+        return self.schedule(interval, run)
+
+    def cancel(self, timer_id):
+        # الإلغاء كسول: المدخل يبقى في الكومة ويُتجاهل عند موعده
+        with self.cond:
+            self.pending.discard(timer_id)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.heap:
+                    self.cond.wait()
+                due_at, timer_id, func, args = self.heap[0]
+                now = time.monotonic()
+                if due_at > now:
+                    self.cond.wait(due_at - now)
+                    continue
+                heapq.heappop(self.heap)
+                if timer_id not in self.pending:
+                    continue
+                self.pending.discard(timer_id)
+            try:
+                func(*args)
+            except Exception:
+                telebot.logger.exception("timer callback failed")
+
+timers = TimerService()
+
+# =================== طابور الرسائل الصادرة ===================
+# المعالجات تضع الرسائل في الطابور وتعود فورًا؛ خيوط الإرسال تحترم حدود تيليجرام
+# وتعيد المحاولة عند 429/5xx، مع الحفاظ على ترتيب رسائل كل محادثة
+
+PRIORITY_TRIP = 0
+PRIORITY_NORMAL = 1
+PRIORITY_MENU = 2
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        # يرجع 0 إن أُخذ رمز، وإلا عدد الثواني حتى يتوفر رمز
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class OutboundQueue:
+    def __init__(self, workers=SEND_WORKERS, global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE,
+                 chat_burst=SEND_CHAT_BURST, max_retries=SEND_MAX_RETRIES):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.cond = threading.Condition()
+        # كومة (أولوية، تسلسل، محادثة): الأولوية تختار المحادثة التالية فقط، ورسائل المحادثة تخرج بترتيبها
+        self.ready = []
+        # كومة (موعد، تسلسل، محادثة): محادثات تنتظر حد المعدل أو إعادة المحاولة
+        self.delayed = []
+        # المحادثة -> طابور رسائلها بالترتيب
+        self.chats = {}
+        # محادثات لها رسالة قيد الإرسال أو مؤجلة؛ لا تُخدم مرة ثانية حتى تنتهي
+        self.busy = set()
+        self.pending = 0
+        self.seq = 0
+        self.threads = []
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+
+    def __len__(self):
+        return self.pending
+
+    def put(self, chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+        with self.cond:
+            self.seq += 1
+            item = {"seq": self.seq, "priority": priority, "chat_id": chat_id, "text": text, "kwargs": kwargs, "attempts": 0}
+            self.chats.setdefault(chat_id, deque()).append(item)
+            if chat_id not in self.busy:
+                heapq.heappush(self.ready, (priority, item["seq"], chat_id))
+            self.pending += 1
+            if not self.threads:
+                for i in range(self.workers):
+                    t = threading.Thread(target=self._worker, name=f"send-worker-{i}", daemon=True)
+                    t.start()
+                    self.threads.append(t)
+            self.cond.notify()
+
+    def flush(self, timeout=None):
+        # ينتظر حتى يفرغ الطابور (للاختبارات وإيقاف البوت)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                for key in [k for k, b in self.chat_buckets.items() if k not in self.chats and (now - b.updated) * b.rate >= b.burst]:
+                    del self.chat_buckets[key]
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _wake(self, chat_id):
+        waiting = self.chats.get(chat_id)
+        if waiting:
+            # المحادثة تأخذ أعلى أولوية بين رسائلها المنتظرة حتى لا تعلق رسالة رحلة خلف قائمة
+            heapq.heappush(self.ready, (min(item["priority"] for item in waiting), waiting[0]["seq"], chat_id))
+        else:
+            self.chats.pop(chat_id, None)
+
+    def _delay(self, chat_id, until):
+        self.busy.add(chat_id)
+        heapq.heappush(self.delayed, (until, self.chats[chat_id][0]["seq"], chat_id))
+
+    def _next(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self.delayed)
+                    self.busy.discard(chat_id)
+                    self._wake(chat_id)
+                if not self.ready:
+                    self.cond.wait(self.delayed[0][0] - now if self.delayed else None)
+                    continue
+                _, _, chat_id = heapq.heappop(self.ready)
+                if chat_id in self.busy or not self.chats.get(chat_id):
+                    continue
+                wait = self._chat_bucket(chat_id, now).take(now)
+                if wait:
+                    self._delay(chat_id, now + wait)
+                    continue
+                wait = self.global_bucket.take(now)
+                if wait:
+                    self._delay(chat_id, now + wait)
+                    self.cond.wait(wait)
+                    continue
+                self.busy.add(chat_id)
+                return self.chats[chat_id].popleft()
+
+    def _retry(self, item, delay):
+        # الرسالة تعود لرأس طابور محادثتها، والمحادثة تبقى محجوزة حتى موعد المحاولة
+        with self.cond:
+            self.retries += 1
+            metrics.inc("bot_send_retries_total")
+            chat_id = item["chat_id"]
+            self.chats.setdefault(chat_id, deque()).appendleft(item)
+            heapq.heappush(self.delayed, (time.monotonic() + delay, item["seq"], chat_id))
+            self.cond.notify()
+
+    def _done(self, item):
+        with self.cond:
+            chat_id = item["chat_id"]
+            self.busy.discard(chat_id)
+            self._wake(chat_id)
+            self.pending -= 1
+            self.cond.notify_all()
+
+    def _worker(self):
+        while True:
+            item = self._next()
+            started = time.perf_counter()
+            try:
+                bot.send_message(item["chat_id"], item["text"], **item["kwargs"])
+                send_seconds.observe(time.perf_counter() - started)
+                self.sent += 1
+            except telebot.apihelper.ApiTelegramException as e:
+                item["attempts"] += 1
+                if e.error_code == 429 and item["attempts"] <= self.max_retries:
+                    retry_after = (e.result_json or {}).get("parameters", {}).get("retry_after", 1)
+                    self._retry(item, retry_after)
+                    continue
+                if e.error_code >= 500 and item["attempts"] <= self.max_retries:
+                    self._retry(item, min(30, 0.5 * 2 ** item["attempts"]))
+                    continue
+                self.failed += 1
+                telebot.logger.error(f"send_message to {item['chat_id']} failed: {e}")
+            except Exception as e:
+                item["attempts"] += 1
+                if item["attempts"] <= self.max_retries:
+                    self._retry(item, min(30, 0.5 * 2 ** item["attempts"]))
+                    continue
+                self.failed += 1
+                telebot.logger.error(f"send_message to {item['chat_id']} failed: {e}")
+            self._done(item)
+
+outbound = OutboundQueue()
+send_seconds = metrics.histogram("bot_telegram_send_seconds")
+
+def send_message(chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+    outbound.put(chat_id, text, priority, **kwargs)
+
+# =================== التوزيع الدفعي ===================
+
+def distance_matrix(starts, ends):
+    # مصفوفة haversine (كم) بين نقاط starts (n,2) و ends (m,2)
+    lat1 = np.radians(starts[:, 0])[:, None]
+    lon1 = np.radians(starts[:, 1])[:, None]
+    lat2 = np.radians(ends[:, 0])[None, :]
+    lon2 = np.radians(ends[:, 1])[None, :]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+def hungarian(cost):
+    # الخوارزمية المجرية O(n^2 m) لمصفوفة n <= m؛ ترجع [(صف, عمود)]
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=int)
+    way = np.zeros(m + 1, dtype=int)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            cur = cost[i0 - 1] - u[i0] - v[1:]
+            free = ~used[1:]
+            better = free & (cur < minv[1:])
+            minv[1:][better] = cur[better]
+            way[1:][better] = j0
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[1:][free] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    return [(p[j] - 1, j - 1) for j in range(1, m + 1) if p[j]]
+
+def greedy_assignment(cost):
+    # أرخص الأزواج أولًا؛ مناسبة للدفعات الكبيرة
+    order = np.argsort(cost, axis=None)
+    rows, cols = np.unravel_index(order, cost.shape)
+    used_rows, used_cols, pairs = set(), set(), []
+    for r, c in zip(rows.tolist(), cols.tolist()):
+        if not np.isfinite(cost[r, c]):
             break
-        lat, lon = status_obj["location"]
-        lat += random.uniform(-0.0005, 0.0005)
-        lon += random.uniform(-0.0005, 0.0005)
-        set_driver_status(driver_id, "متوفر", lat, lon)
-        time.sleep(5)
+        if r in used_rows or c in used_cols:
+            continue
+        used_rows.add(r)
+        used_cols.add(c)
+        pairs.append((r, c))
+    return pairs
+
+def match_trips(trips, drivers):
+    # trips: قائمة رحلات، drivers: {driver_id: {"lat","lon","gender","balance"}}
+    # يرجع [(رحلة, driver_id, المسافة)] مع احترام الجنس والحد الأدنى للرصيد
+    if not trips or not drivers:
+        return []
+    driver_ids = list(drivers)
+    starts = np.array([trip["start"] for trip in trips], dtype=float)
+    ends = np.array([(drivers[d]["lat"], drivers[d]["lon"]) for d in driver_ids], dtype=float)
+    cost = distance_matrix(starts, ends)
+    genders = np.array([drivers[d]["gender"] for d in driver_ids], dtype=object)
+    balances = np.array([drivers[d]["balance"] for d in driver_ids], dtype=float)
+    trip_genders = np.array([trip["gender"] for trip in trips], dtype=object)
+    eligible = (trip_genders[:, None] == genders[None, :]) & (balances[None, :] >= MIN_DRIVER_BALANCE)
+    eligible &= cost <= MAX_PICKUP_KM
+    cost = np.where(eligible, cost, np.inf)
+    if max(cost.shape) <= HUNGARIAN_MAX:
+        # الخوارزمية المجرية تحتاج قيمًا محدودة وعدد صفوف <= عدد الأعمدة
+        big = (np.nanmax(cost[np.isfinite(cost)]) + 1) * (min(cost.shape) + 1) if np.isfinite(cost).any() else 1
+        finite_cost = np.where(np.isfinite(cost), cost, big)
+        if cost.shape[0] <= cost.shape[1]:
+            pairs = hungarian(finite_cost)
+        else:
+            pairs = [(r, c) for c, r in hungarian(finite_cost.T)]
+        pairs = [(r, c) for r, c in pairs if np.isfinite(cost[r, c])]
+    else:
+        pairs = greedy_assignment(cost)
+    return [(trips[r], driver_ids[c], float(cost[r, c])) for r, c in pairs]
+
+class DispatchMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.trips = 0
+        self.matched = 0
+        self.matching_seconds = 0.0
+        self.max_matching_seconds = 0.0
+        self.pickup_km = 0.0
+
+    def record(self, trips, matches, seconds):
+        with self.lock:
+            self.batches += 1
+            self.trips += trips
+            self.matched += len(matches)
+            self.matching_seconds += seconds
+            self.max_matching_seconds = max(self.max_matching_seconds, seconds)
+            self.pickup_km += sum(km for _, _, km in matches)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "batches": self.batches,
+                "trips": self.trips,
+                "matched": self.matched,
+                "avg_matching_ms": self.matching_seconds / self.batches * 1000 if self.batches else 0,
+                "max_matching_ms": self.max_matching_seconds * 1000,
+                "avg_pickup_km": self.pickup_km / self.matched if self.matched else 0
+            }
+
+dispatch_metrics = DispatchMetrics()
+
+class BatchDispatcher:
+    # يجمع الرحلات المعلقة خلال نافذة قصيرة ثم يطابقها كلها دفعة واحدة
+    def __init__(self, window=DISPATCH_WINDOW, candidates=DISPATCH_CANDIDATES):
+        self.window = window
+        self.candidates = candidates
+        self.lock = threading.Lock()
+        self.pending = []
+        self.thread = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def submit(self, trip):
+        with self.lock:
+            self.pending.append(trip)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="batch-dispatcher", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.window)
+            with self.lock:
+                trips, self.pending = self.pending, []
+            if trips:
+                try:
+                    self.dispatch(trips)
+                except Exception:
+                    telebot.logger.exception("batch dispatch failed")
+
+    @instrumented("bot_dispatch_seconds", "batch_dispatch", "step")
+    def dispatch(self, trips):
+        started = time.perf_counter()
+        # السائقون المرشحون: اتحاد أقرب السائقين المؤهلين لكل رحلة
+        # (السائقون الذين لديهم عرض قائم مستبعدون؛ ترتيب كل رحلة يُحفظ كقائمة مرشحيها)
+        drivers = {}
+        ranked = {}
+        with driver_index.lock:
+            for trip in trips:
+                ranked[id(trip)] = []
+                k, max_km = zone_stats.search_limits(trip["start"], self.candidates)
+                for _, driver_id in driver_index.nearest(trip["start"], k, trip["gender"], MIN_DRIVER_BALANCE, max_km):
+                    if trip_offers.busy(driver_id):
+                        continue
+                    ranked[id(trip)].append(driver_id)
+                    drivers[driver_id] = dict(driver_index.drivers[driver_id])
+        # من قبل رحلة يبقى "متوفر" في الفهرس حتى يوصلها
+        on_trip = drivers_on_trips(drivers)
+        for driver_id in on_trip:
+            del drivers[driver_id]
+        for trip in trips:
+            ranked[id(trip)] = [d for d in ranked[id(trip)] if d not in on_trip]
+        matches = match_trips(trips, drivers)
+        dispatch_metrics.record(len(trips), matches, time.perf_counter() - started)
+        matched = set()
+        for trip, driver_id, _ in matches:
+            matched.add(id(trip))
+            trip_offers.start(trip, [driver_id] + [d for d in ranked[id(trip)] if d != driver_id])
+        for trip in trips:
+            if id(trip) not in matched:
+                trip_offers.start(trip, ranked[id(trip)])
+        return matches
+
+batch_dispatcher = BatchDispatcher()
+
+# =================== عروض الرحلات ===================
+# لكل رحلة قائمة مرشحين مرتبة تُحسب مرة واحدة عند الطلب؛ الرفض أو انتهاء المهلة
+# يسحب المرشح التالي من أول الطابور مباشرة بدون إعادة البحث، ولا يُعرض على نفس السائق مرتين
+
+OFFER_BUCKETS = (1, 2, 3, 4, 5, 7, 10, 15, 20)
+
+class TripOffers:
+    # sequential: عرض واحد قائم لكل رحلة؛ fanout: أقرب OFFER_FANOUT سائقين معًا وأول من يقبل يفوز.
+    # العروض محفوظة في جدول trip_offers (open ثم accepted/rejected/expired/withdrawn) فتراها كل العمليات
+    # وتبقى بعد إعادة التشغيل؛ الذاكرة تحفظ فقط قائمة المرشحين المرتبة ومؤقتات عروض هذه العملية.
+    # trips.driver_id لا يُضبط إلا عند القبول (compare-and-set مشروط بأن عرض السائق ما زال مفتوحًا)
+    def __init__(self, mode=OFFER_MODE, fanout=OFFER_FANOUT, timeout=OFFER_TIMEOUT):
+        self.width = max(1, fanout) if mode == "fanout" else 1
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # trip_id -> {"trip", "candidates"}
+        self.trips = {}
+        # (trip_id, driver_id) -> timer_id لعروض هذه العملية
+        self.timers = {}
+        # driver_id -> trip_id: نسخة محلية تستبعد بها rank_candidates السائقين المشغولين بدون قاعدة البيانات
+        self.drivers = {}
+
+    def __len__(self):
+        return len(self.trips)
+
+    def busy(self, driver_id):
+        return driver_id in self.drivers
+
+    def offered_trip(self, driver_id):
+        row = db_connection().execute(
+            "SELECT trip_id FROM trip_offers WHERE driver_id = ? AND status = 'open'", (driver_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def start(self, trip, candidates):
+        with self.lock:
+            self.trips[trip["trip_id"]] = {"trip": trip, "candidates": deque(candidates)}
+        self.fill(trip["trip_id"])
+
+    def _state(self, trip_id):
+        with self.lock:
+            state = self.trips.get(trip_id)
+        if state is not None:
+            return state
+        # الرحلة بدأتها عملية أخرى أو بدأت قبل إعادة التشغيل: ترتيب جديد بدون من عُرضت عليهم سابقًا
+        trip = get_trip(trip_id)
+        if trip is None or trip["driver_id"] is not None:
+            return None
+        offered = {row[0] for row in db_connection().execute("SELECT driver_id FROM trip_offers WHERE trip_id = ?", (trip_id,))}
+        candidates = deque(driver_id for _, driver_id in rank_candidates(trip, exclude=offered))
+        with self.lock:
+            return self.trips.setdefault(trip_id, {"trip": trip, "candidates": candidates})
+
+    def eligible(self, conn, driver_id, trip):
+        # السائق ما زال متوفرًا ومتوافقًا ورصيده كافٍ، وليس لديه عرض مفتوح آخر ولا رحلة قبلها
+        with driver_index.lock:
+            driver = driver_index.drivers.get(driver_id)
+            if not driver or driver["gender"] != trip["gender"] or driver["balance"] < MIN_DRIVER_BALANCE:
+                return False
+        if conn.execute("SELECT 1 FROM trip_offers WHERE driver_id = ? AND status = 'open'", (driver_id,)).fetchone():
+            return False
+        return conn.execute("SELECT 1 FROM trips WHERE driver_id = ?", (driver_id,)).fetchone() is None
+
+    def _track(self, trip_id, driver_id, delay):
+        with self.lock:
+            self.drivers[driver_id] = trip_id
+            self.timers[(trip_id, driver_id)] = timers.schedule(delay, self.expire, trip_id, driver_id)
+
+    def _forget(self, trip_id, driver_id):
+        with self.lock:
+            timer_id = self.timers.pop((trip_id, driver_id), None)
+            if self.drivers.get(driver_id) == trip_id:
+                del self.drivers[driver_id]
+        if timer_id is not None:
+            timers.cancel(timer_id)
+
+    def fill(self, trip_id):
+        # يكمل العروض المفتوحة حتى العرض المطلوب من أول قائمة المرشحين؛ العد والإلغاء في نفس
+        # معاملة القبول المتسلسلة، فلا تُلغى رحلة بينما سائق يقبلها
+        state = self._state(trip_id)
+        if state is None:
+            return
+        trip = state["trip"]
+        new_offers = []
+        with db_transaction() as conn:
+            row = conn.execute("SELECT driver_id FROM trips WHERE id = ?", (trip_id,)).fetchone()
+            if row is None or row[0] is not None:
+                # قُبلت أو أُلغيت (ربما في عملية أخرى)
+                with self.lock:
+                    self.trips.pop(trip_id, None)
+                return
+            open_offers = conn.execute(
+                "SELECT COUNT(*) FROM trip_offers WHERE trip_id = ? AND status = 'open'", (trip_id,)
+            ).fetchone()[0]
+            expires_at = time.time() + self.timeout
+            while open_offers + len(new_offers) < self.width and state["candidates"]:
+                candidate = state["candidates"].popleft()
+                if self.eligible(conn, candidate, trip) and conn.execute(
+                    "INSERT OR IGNORE INTO trip_offers (trip_id, driver_id, status, expires_at) VALUES (?, ?, 'open', ?)",
+                    (trip_id, candidate, expires_at)
+                ).rowcount == 1:
+                    new_offers.append(candidate)
+            unmatched = open_offers == 0 and not new_offers
+            if unmatched:
+                archive_trip(trip_id, "cancelled")
+        if unmatched:
+            with self.lock:
+                self.trips.pop(trip_id, None)
+            metrics.inc("bot_trips_unmatched_total")
+            zone_stats.record(trip["start"], "unmatched")
+            notify_no_driver(trip)
+        for driver_id in new_offers:
+            self._track(trip_id, driver_id, self.timeout)
+            offer_trip(trip, driver_id)
+
+    def _close(self, trip_id, driver_id, status):
+        # يغلق عرضًا مفتوحًا؛ False إن لم يكن مفتوحًا (قُبل أو انتهى أو سُحب، ربما في عملية أخرى)
+        with db_transaction() as conn:
+            closed = conn.execute(
+                "UPDATE trip_offers SET status = ? WHERE trip_id = ? AND driver_id = ? AND status = 'open'",
+                (status, trip_id, driver_id)
+            ).rowcount == 1
+        self._forget(trip_id, driver_id)
+        return closed
+
+    def accept(self, driver_id, trip_id):
+        # يرجع الرحلة للفائز، أو None إذا سبقه سائق آخر أو انتهت مهلة العرض.
+        # compare-and-set وإغلاق العروض الأخرى في معاملة واحدة
+        now = time.time()
+        with db_transaction() as conn:
+            won = conn.execute("""
+                UPDATE trips SET driver_id = ?, accepted_at = ? WHERE id = ? AND driver_id IS NULL
+                AND EXISTS (SELECT 1 FROM trip_offers WHERE trip_id = ? AND driver_id = ? AND status = 'open')
+                AND NOT EXISTS (SELECT 1 FROM trips WHERE driver_id = ?)
+            """, (driver_id, now, trip_id, trip_id, driver_id, driver_id)).rowcount == 1
+            if won:
+                conn.execute("UPDATE trip_offers SET status = 'accepted' WHERE trip_id = ? AND driver_id = ?", (trip_id, driver_id))
+                losers = [row[0] for row in conn.execute(
+                    "UPDATE trip_offers SET status = 'withdrawn' WHERE trip_id = ? AND status = 'open' RETURNING driver_id", (trip_id,)
+                ).fetchall()]
+                offers = conn.execute("SELECT COUNT(*) FROM trip_offers WHERE trip_id = ?", (trip_id,)).fetchone()[0]
+                conn.execute("INSERT INTO trip_events (trip_id, status, driver_id, created_at) VALUES (?, 'accepted', ?, ?)",
+                             (trip_id, driver_id, now))
+        self._forget(trip_id, driver_id)
+        if not won:
+            return None
+        with self.lock:
+            state = self.trips.pop(trip_id, None)
+        for loser in losers:
+            self._forget(trip_id, loser)
+        trip = state["trip"] if state else get_trip(trip_id)
+        metrics.histogram("bot_offers_per_match", OFFER_BUCKETS).observe(offers)
+        zone_stats.record(trip["start"], "matches")
+        for loser in losers:
+            metrics.inc("bot_offers_withdrawn_total")
+            send_message(loser, "🚫 تم قبول الرحلة من سائق آخر.", PRIORITY_TRIP, reply_markup=types.ReplyKeyboardRemove())
+        return trip
+
+    def reject(self, driver_id, trip_id):
+        if not self._close(trip_id, driver_id, "rejected"):
+            return False
+        metrics.inc("bot_offer_rejections_total")
+        state = self._state(trip_id)
+        if state:
+            zone_stats.record(state["trip"]["start"], "rejections")
+        self.fill(trip_id)
+        return True
+
+    def expire(self, trip_id, driver_id):
+        if not self._close(trip_id, driver_id, "expired"):
+            return
+        metrics.inc("bot_offer_timeouts_total")
+        send_message(driver_id, "⌛ انتهت مهلة العرض.", PRIORITY_TRIP, reply_markup=types.ReplyKeyboardRemove())
+        self.fill(trip_id)
+
+    def recover(self):
+        # بعد إعادة التشغيل: العروض المفتوحة تستعيد مؤقتاتها، وكل رحلة بلا سائق تُكمل عروضها
+        # أو تُلغى ويُبلغ الراكب إن لم يبق مرشح
+        now = time.time()
+        conn = db_connection()
+        for trip_id, driver_id, expires_at in conn.execute("""
+            SELECT o.trip_id, o.driver_id, o.expires_at FROM trip_offers o
+            JOIN trips t ON t.id = o.trip_id
+            WHERE o.status = 'open' AND t.driver_id IS NULL
+        """).fetchall():
+            self._track(trip_id, driver_id, max(0, expires_at - now))
+        for (trip_id,) in conn.execute("SELECT id FROM trips WHERE driver_id IS NULL").fetchall():
+            self.fill(trip_id)
+
+trip_offers = TripOffers()
+
+def drivers_on_trips(driver_ids):
+    # السائقون الذين قبلوا رحلة لم تنته بعد (استعلام واحد بالفهرس idx_trips_driver_id)
+    driver_ids = list(driver_ids)
+    on_trip = set()
+    conn = db_connection()
+    for i in range(0, len(driver_ids), SQLITE_MAX_VARS):
+        chunk = driver_ids[i:i + SQLITE_MAX_VARS]
+        on_trip.update(row[0] for row in conn.execute(
+            f"SELECT driver_id FROM trips WHERE driver_id IN ({','.join('?' * len(chunk))})", chunk
+        ))
+    return on_trip
+
+def rank_candidates(trip, exclude=()):
+    # [(المسافة, driver_id)] مرتبة، بدون المستبعدين ومن لديهم عرض قائم أو رحلة مقبولة
+    k, max_km = zone_stats.search_limits(trip["start"], OFFER_CANDIDATES)
+    nearest = [(km, driver_id) for km, driver_id in driver_index.nearest(trip["start"], k + len(exclude), trip["gender"], MIN_DRIVER_BALANCE, max_km)
+               if driver_id not in exclude and not trip_offers.busy(driver_id)]
+    on_trip = drivers_on_trips(driver_id for _, driver_id in nearest)
+    return [(km, driver_id) for km, driver_id in nearest if driver_id not in on_trip]
+
+# =================== حالة المحادثات ===================
+# كل خطوة متعددة المراحل تحفظ اسم الخطوة التالية وبياناتها في مخزن قابل للتبديل،
+# فيستطيع أي عامل (أو عملية) استئناف المحادثة حتى بعد إعادة التشغيل
+
+class SQLiteConversationStore:
+    def get(self, chat_id):
+        row = db_connection().execute(
+            "SELECT step, data FROM conversation_state WHERE chat_id = ? AND updated_at >= ?",
+            (chat_id, time.time() - CONVERSATION_TTL)
+        ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def set(self, chat_id, step, data):
+        with db_transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO conversation_state (chat_id, step, data, updated_at) VALUES (?, ?, ?, ?)",
+                (chat_id, step, json.dumps(data), time.time())
+            )
+
+    def pop(self, chat_id):
+        # أغلب الرسائل بلا خطوة معلقة: قراءة أولًا (لا تنتظر الكتّاب في WAL)، ثم حذف وقراءة في جملة
+        # واحدة فقط إن وُجدت خطوة حتى لا يستأنف عاملان نفس الخطوة
+        conn = db_connection()
+        if conn.execute("SELECT 1 FROM conversation_state WHERE chat_id = ?", (chat_id,)).fetchone() is None:
+            return None
+        rows = conn.execute(
+            "DELETE FROM conversation_state WHERE chat_id = ? RETURNING step, data, updated_at", (chat_id,)
+        ).fetchall()
+        row = rows[0] if rows else None
+        if not row or row[2] < time.time() - CONVERSATION_TTL:
+            return None
+        return row[0], json.loads(row[1])
+
+    def clear(self, chat_id):
+        with db_transaction() as conn:
+            conn.execute("DELETE FROM conversation_state WHERE chat_id = ?", (chat_id,))
+
+class MemoryConversationStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}
+
+    def get(self, chat_id):
+        with self.lock:
+            entry = self.states.get(chat_id)
+        if not entry or entry[2] < time.time() - CONVERSATION_TTL:
+            return None
+        return entry[0], json.loads(entry[1])
+
+    def set(self, chat_id, step, data):
+        with self.lock:
+            self.states[chat_id] = (step, json.dumps(data), time.time())
+
+    def pop(self, chat_id):
+        with self.lock:
+            entry = self.states.pop(chat_id, None)
+        if not entry or entry[2] < time.time() - CONVERSATION_TTL:
+            return None
+        return entry[0], json.loads(entry[1])
+
+    def clear(self, chat_id):
+        with self.lock:
+            self.states.pop(chat_id, None)
+
+conversations = MemoryConversationStore() if CONVERSATION_BACKEND == "memory" else SQLiteConversationStore()
+
+STEP_HANDLERS = {}
+
+def conversation_step(func):
+    STEP_HANDLERS[func.__name__] = func
+    return func
+
+def set_next_step(chat_id, step, **data):
+    conversations.set(chat_id, step.__name__, data)
+
+def resume_conversation(message):
+    # يرجع True إن كانت الرسالة جزءًا من محادثة جارية وتمت معالجتها
+    state = conversations.pop(message.chat.id)
+    if not state:
+        return False
+    step, data = state
+    STEP_HANDLERS[step](message, **data)
+    return True
+
+# =================== الموجه ===================
+# كل رسالة تمر بمعالج واحد: المستخدم يُقرأ مرة واحدة في سياق التحديث، ثم بحث واحد في جدول
+# (الدور، نص الزر) -> معالج بدل فلاتر متتالية وسلاسل if/elif؛ الكلفة ثابتة مهما زادت القوائم
+
+class UpdateContext:
+    __slots__ = ("message", "chat_id", "user_id", "text", "key", "_user")
+
+    def __init__(self, message):
+        self.message = message
+        self.chat_id = message.chat.id
+        self.user_id = message.from_user.id
+        self.text = message.text
+        # النصوص تُطابق كما هي، وغير النصوص (مثل الموقع) بنوع المحتوى
+        self.key = message.text if message.content_type == 'text' else ("content", message.content_type)
+        self._user = _MISSING
+
+    @property
+    def user(self):
+        if self._user is _MISSING:
+            self._user = get_user(self.user_id)
+        return self._user
+
+    @property
+    def role(self):
+        return self.user["role"] if self.user else None
+
+# (role, key) -> handler؛ role = None يعني أي مستخدم (حتى غير المسجل)
+ROUTES = {}
+# key -> أولوية التحديث في المجدول (تُعرف من النص وحده، بدون قراءة المستخدم)
+ROUTE_PRIORITIES = {}
+# معالج الرسائل النصية غير المعروفة لكل دور
+ROLE_DEFAULTS = {}
+
+def route(role, *texts, content_type=None, priority=PRIORITY_MENU):
+    def decorator(func):
+        handler = instrumented("bot_route_seconds", func.__name__, "route")(func)
+        keys = list(texts) + ([("content", content_type)] if content_type else [])
+        for key in keys:
+            ROUTES[(role, key)] = handler
+            ROUTE_PRIORITIES[key] = min(priority, ROUTE_PRIORITIES.get(key, priority))
+        return func
+    return decorator
+
+def role_default(role):
+    def decorator(func):
+        ROLE_DEFAULTS[role] = instrumented("bot_route_seconds", func.__name__, "route")(func)
+        return func
+    return decorator
+
+def admin_only(func):
+    @functools.wraps(func)
+    def wrapper(ctx):
+        if not ctx.user.get("admin"):
+            send_message(ctx.chat_id, "ليس لديك صلاحية الأدمن.")
+            return
+        return func(ctx)
+    return wrapper
+
+def find_route(ctx):
+    role = ctx.role
+    handler = ROUTES.get((role, ctx.key)) or ROUTES.get((None, ctx.key))
+    if handler is None and ctx.text and ctx.text.startswith('/'):
+        # أوامر مثل /start@bot أو /start payload
+        command = ctx.text.split()[0].split('@')[0]
+        handler = ROUTES.get((role, command)) or ROUTES.get((None, command))
+    if handler is None and ctx.text is not None:
+        handler = ROLE_DEFAULTS.get(role)
+    return handler
 
 # =================== البوت ===================
 
-@bot.message_handler(commands=['start'])
-def start(message):
-    telegram_id = message.from_user.id
-    username = message.from_user.username or ""
-    user = get_user(telegram_id)
+@bot.message_handler(content_types=['text', 'location'])
+def router(message):
+    # pop الذري هو البحث الوحيد عن المحادثة: إن لم توجد خطوة معلقة تُوجه الرسالة عاديًا
+    if resume_conversation(message):
+        return
+    ctx = UpdateContext(message)
+    handler = find_route(ctx)
+    if handler:
+        handler(ctx)
+
+@route(None, '/start')
+def start(ctx):
+    username = ctx.message.from_user.username or ""
+    user = ctx.user
     if user:
-        bot.send_message(message.chat.id, f"مرحبا {username}! أنت مسجل كـ {user['role']}")
-        show_menu(message, user['role'])
+        send_message(ctx.chat_id, f"مرحبا {username}! أنت مسجل كـ {user['role']}")
+        show_menu(ctx.message, user['role'])
     else:
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
         markup.add('سائق 🚖', 'راكب 🧍', 'أدمن 🔑')
-        bot.send_message(message.chat.id, "اختر دورك:", reply_markup=markup)
+        send_message(ctx.chat_id, "اختر دورك:", reply_markup=markup)
 
-@bot.message_handler(func=lambda message: message.text in ['سائق 🚖','راكب 🧍','أدمن 🔑'])
-def set_role(message):
-    telegram_id = message.from_user.id
+@route(None, 'سائق 🚖', 'راكب 🧍', 'أدمن 🔑', priority=PRIORITY_NORMAL)
+def set_role(ctx):
+    message = ctx.message
     username = message.from_user.username or ""
     role = message.text.split()[0]
     if role == "أدمن":
-        msg = bot.send_message(message.chat.id, "ادخل الأمر السري للأدمن:")
-        bot.register_next_step_handler(msg, check_admin_password)
+        send_message(message.chat.id, "ادخل الأمر السري للأدمن:")
+        set_next_step(message.chat.id, check_admin_password)
     else:
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
         markup.add('ذكر 👨', 'أنثى 👩')
-        msg = bot.send_message(message.chat.id, "اختر جنسك:", reply_markup=markup)
-        bot.register_next_step_handler(msg, set_gender, role, username)
+        send_message(message.chat.id, "اختر جنسك:", reply_markup=markup)
+        set_next_step(message.chat.id, set_gender, role=role, username=username)
 
+@conversation_step
 def check_admin_password(message):
     telegram_id = message.from_user.id
     username = message.from_user.username or ""
     if message.text == ADMIN_PASSWORD:
         # الأدمن من ID ويخزن كـ admin=1
         set_user(telegram_id, username, "أدمن", admin=1)
-        bot.send_message(message.chat.id, "✅ تم تسجيلك كأدمن!")
+        send_message(message.chat.id, "✅ تم تسجيلك كأدمن!")
         show_menu(message, "أدمن")
     else:
-        bot.send_message(message.chat.id, "❌ كلمة السر خاطئة! لا يمكنك الدخول كأدمن.")
+        send_message(message.chat.id, "❌ كلمة السر خاطئة! لا يمكنك الدخول كأدمن.")
 
+@conversation_step
 def set_gender(message, role, username):
     gender = message.text.split()[0]
     telegram_id = message.from_user.id
     if gender not in ["ذكر", "أنثى"]:
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
         markup.add('ذكر 👨', 'أنثى 👩')
-        msg = bot.send_message(message.chat.id, "اختر جنس صالح:", reply_markup=markup)
-        bot.register_next_step_handler(msg, set_gender, role, username)
+        send_message(message.chat.id, "اختر جنس صالح:", reply_markup=markup)
+        set_next_step(message.chat.id, set_gender, role=role, username=username)
         return
     initial_balance = 10 if role == "سائق" else 0
     set_user(telegram_id, username, role, gender, initial_balance)
     if role == "سائق":
-        bot.send_message(message.chat.id, "🎉 مرحبا بك كسائق جديد!\nلقد تم منحك 10 دينار هدية كمكافأة تسجيل.")
-    bot.send_message(message.chat.id, f"تم تسجيلك كـ {role} وجنسك {gender}")
+        send_message(message.chat.id, "🎉 مرحبا بك كسائق جديد!\nلقد تم منحك 10 دينار هدية كمكافأة تسجيل.")
+    send_message(message.chat.id, f"تم تسجيلك كـ {role} وجنسك {gender}")
     show_menu(message, role)
 
 def show_menu(message, role):
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
     if role == 'سائق':
         markup.add('متوفر ✅', 'مشغول ⛔', 'عرض الرصيد 💰', 'شحن رصيد 📲')
-        bot.send_message(message.chat.id, "اختر حالتك أو اعرض رصيدك:", reply_markup=markup)
+        send_message(message.chat.id, "اختر حالتك أو اعرض رصيدك:", PRIORITY_MENU, reply_markup=markup)
     elif role == 'راكب':
         markup.add('طلب رحلة 🛺')
-        bot.send_message(message.chat.id, "اختر ما تريد:", reply_markup=markup)
+        send_message(message.chat.id, "اختر ما تريد:", PRIORITY_MENU, reply_markup=markup)
     elif role == 'أدمن':
-        markup.add('عرض بيانات مستخدم 👤', 'إضافة رصيد ➕', 'خصم رصيد ➖')
-        bot.send_message(message.chat.id, "قائمة الأدمن:", reply_markup=markup)
+        markup.add('عرض بيانات مستخدم 👤', 'إضافة رصيد ➕', 'خصم رصيد ➖', 'إحصائيات المناطق 📊')
+        send_message(message.chat.id, "قائمة الأدمن:", PRIORITY_MENU, reply_markup=markup)
 
-@bot.message_handler(func=lambda message: get_user(message.from_user.id) and get_user(message.from_user.id).get("role") == 'سائق')
-def driver_actions(message):
-    telegram_id = message.from_user.id
-    text = message.text
-    user = get_user(telegram_id)
-    if not user:
+@route('سائق', 'متوفر ✅', priority=PRIORITY_TRIP)
+def driver_available(ctx):
+    telegram_id = ctx.user_id
+    live = live_locations.get(telegram_id)
+    if live:
+        set_driver_status(telegram_id, 'متوفر', *live)
+        send_message(ctx.chat_id, "📍 أنت الآن متوفر! يتم استخدام موقعك المباشر.")
         return
-    if text == 'متوفر ✅':
-        lat = random.uniform(32, 33)
-        lon = random.uniform(13, 15)
-        set_driver_status(telegram_id, 'متوفر', lat, lon)
-        bot.send_message(message.chat.id, "📍 أنت الآن متوفر! يتم تحديث موقعك تلقائيًا.")
-        threading.Thread(target=gps_update_loop, args=(telegram_id,), daemon=True).start()
-    elif text == 'مشغول ⛔':
-        set_driver_status(telegram_id, 'مشغول')
-        bot.send_message(message.chat.id, "⛔ أنت الآن مشغول.")
-    elif text == 'عرض الرصيد 💰':
-        bot.send_message(message.chat.id, f"💵 رصيدك الحالي: {user['balance']} دينار")
-    elif text == 'شحن رصيد 📲':
-        bot.send_message(message.chat.id, "🔗 للتواصل شحن الرصيد عبر واتساب: https://wa.me/218923128567")
-    elif text in ['/قبول ✅','/رفض ❌']:
-        handle_trip_response(telegram_id, text)
-    elif text.startswith('تم استلام الراكب 🚶'):
+    lat = random.uniform(32, 33)
+    lon = random.uniform(13, 15)
+    set_driver_status(telegram_id, 'متوفر', lat, lon)
+    send_message(ctx.chat_id, "📍 أنت الآن متوفر! يتم تحديث موقعك تلقائيًا.\nشارك موقعك المباشر ليصلك أقرب الركاب.")
+    gps_scheduler.add(telegram_id)
+
+@route('سائق', 'مشغول ⛔', priority=PRIORITY_TRIP)
+def driver_busy(ctx):
+    set_driver_status(ctx.user_id, 'مشغول')
+    send_message(ctx.chat_id, "⛔ أنت الآن مشغول.")
+
+@route('سائق', 'عرض الرصيد 💰')
+def driver_balance(ctx):
+    send_message(ctx.chat_id, f"💵 رصيدك الحالي: {ctx.user['balance']} دينار")
+
+@route('سائق', 'شحن رصيد 📲')
+def driver_top_up(ctx):
+    send_message(ctx.chat_id, "🔗 للتواصل شحن الرصيد عبر واتساب: https://wa.me/218923128567")
+
+@route('سائق', '/قبول ✅', '/رفض ❌', priority=PRIORITY_TRIP)
+def driver_trip_response(ctx):
+    handle_trip_response(ctx.user_id, ctx.text)
+
+@route('سائق', 'تم استلام الراكب 🚶', priority=PRIORITY_TRIP)
+def driver_picked_up(ctx):
+    trip = get_trip_for_driver(ctx.user_id)
+    if trip:
+        record_trip_event(trip["trip_id"], "picked_up", ctx.user_id)
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+    markup.add('تم توصيل الراكب 🏁')
+    send_message(ctx.chat_id, "اضغط عند توصيل الراكب:", reply_markup=markup)
+
+@route('سائق', 'تم توصيل الراكب 🏁', priority=PRIORITY_TRIP)
+def driver_delivered(ctx):
+    telegram_id = ctx.user_id
+    trip = get_trip_for_driver(telegram_id)
+    if trip:
+        with db_transaction():
+            new_balance = post_ledger_entry(telegram_id, -TRIP_COMMISSION, f"commission:trip:{trip['trip_id']}")
+            archive_trip(trip["trip_id"], "completed")
+        send_message(ctx.chat_id, f"✅ تم خصم {TRIP_COMMISSION:g} دينار كعمولة.\n💵 رصيدك الحالي: {new_balance} دينار")
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-        markup.add('تم توصيل الراكب 🏁')
-        bot.send_message(message.chat.id, "اضغط عند توصيل الراكب:", reply_markup=markup)
-    elif text.startswith('تم توصيل الراكب 🏁'):
-        trip = get_trip_for_driver(telegram_id)
-        if trip:
-            new_balance = float(user["balance"]) - 2
-            update_user_field(telegram_id, "balance", new_balance)
-            bot.send_message(message.chat.id, f"✅ تم خصم 2 دينار كعمولة.\n💵 رصيدك الحالي: {new_balance} دينار")
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-            markup.add('1⭐','2⭐','3⭐','4⭐','5⭐')
-            bot.send_message(trip["passenger_id"], "🔔 تم انتهاء الرحلة! الرجاء تقييم السائق:", reply_markup=markup)
-            bot.register_next_step_handler_by_chat_id(trip["passenger_id"], lambda msg: store_rating(telegram_id, msg))
-            remove_trip(trip["trip_id"])
-            show_menu(message, 'سائق')
+        markup.add('1⭐','2⭐','3⭐','4⭐','5⭐')
+        send_message(trip["passenger_id"], "🔔 تم انتهاء الرحلة! الرجاء تقييم السائق:", PRIORITY_TRIP, reply_markup=markup)
+        set_next_step(trip["passenger_id"], store_rating, driver_id=telegram_id)
+        show_menu(ctx.message, 'سائق')
+
+@route('سائق', content_type='location', priority=PRIORITY_TRIP)
+def driver_location(ctx):
+    # بداية مشاركة الموقع المباشر (التحديثات التالية تصل كرسائل معدلة)؛ الموقع الثابت لا يُتتبع
+    location = ctx.message.location
+    if not location.live_period:
+        send_message(ctx.chat_id, "📍 شارك موقعك المباشر (وليس موقعًا ثابتًا) ليصلك أقرب الركاب.")
+        return
+    if live_locations.update(ctx.user_id, location.latitude, location.longitude):
+        send_message(ctx.chat_id, "📍 تم تفعيل الموقع المباشر.")
     else:
-        show_menu(message, 'سائق')
+        send_message(ctx.chat_id, "⛔ اضغط 'متوفر ✅' أولاً ثم شارك موقعك المباشر.")
+
+@role_default('سائق')
+def driver_menu(ctx):
+    show_menu(ctx.message, 'سائق')
 
-def store_rating(driver_id, message):
+@conversation_step
+def store_rating(message, driver_id):
     try:
         rating = int(message.text[0])
         if rating<1 or rating>5: raise ValueError
     except:
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
         markup.add('1⭐','2⭐','3⭐','4⭐','5⭐')
-        msg = bot.send_message(message.chat.id, "ادخل رقم صالح من 1 إلى 5:", reply_markup=markup)
-        bot.register_next_step_handler(msg, lambda m: store_rating(driver_id, m))
+        send_message(message.chat.id, "ادخل رقم صالح من 1 إلى 5:", reply_markup=markup)
+        set_next_step(message.chat.id, store_rating, driver_id=driver_id)
         return
     add_rating(driver_id, rating)
-    user = get_user(driver_id)
-    avg = sum(user["ratings"])/len(user["ratings"]) if user["ratings"] else 0
-    bot.send_message(message.chat.id, f"شكراً لتقييمك! ⭐ متوسط تقييم السائق: {avg:.1f}")
-    bot.send_message(driver_id, f"🔔 تم تقييمك: {rating}⭐\n⭐ متوسط تقييمك الآن: {avg:.1f}")
+    avg = get_rating_summary(driver_id)["average"]
+    send_message(message.chat.id, f"شكراً لتقييمك! ⭐ متوسط تقييم السائق: {avg:.1f}")
+    send_message(driver_id, f"🔔 تم تقييمك: {rating}⭐\n⭐ متوسط تقييمك الآن: {avg:.1f}")
 
-@bot.message_handler(func=lambda message: get_user(message.from_user.id) and get_user(message.from_user.id).get("role") == 'راكب')
-def passenger_actions(message):
-    telegram_id = message.from_user.id
-    text = message.text
-    if text == 'طلب رحلة 🛺':
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-        markup.add(types.KeyboardButton('أرسل موقعي 📍', request_location=True))
-        bot.send_message(message.chat.id, "شارك موقعك لتحديد موقع الانطلاق:", reply_markup=markup)
-    else:
-        show_menu(message, 'راكب')
+@route('راكب', 'طلب رحلة 🛺', priority=PRIORITY_TRIP)
+def passenger_request_trip(ctx):
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+    markup.add(types.KeyboardButton('أرسل موقعي 📍', request_location=True))
+    send_message(ctx.chat_id, "شارك موقعك لتحديد موقع الانطلاق:", reply_markup=markup)
 
-@bot.message_handler(content_types=['location'])
-def location_handler(message):
-    telegram_id = message.from_user.id
-    user = get_user(telegram_id)
-    if not user or user['role'] != 'راكب':
+@route('راكب', content_type='location', priority=PRIORITY_TRIP)
+def passenger_location(ctx):
+    location = (ctx.message.location.latitude, ctx.message.location.longitude)
+    send_message(ctx.chat_id, "أدخل الوجهة (نص):")
+    set_next_step(ctx.chat_id, get_destination_with_location, start_location=location)
+
+@role_default('راكب')
+def passenger_menu(ctx):
+    show_menu(ctx.message, 'راكب')
+
+@bot.edited_message_handler(content_types=['location'])
+def live_location_handler(message):
+    if not message.location.live_period:
         return
-    location = (message.location.latitude, message.location.longitude)
-    msg = bot.send_message(message.chat.id, "أدخل الوجهة (نص):")
-    bot.register_next_step_handler(msg, get_destination_with_location, location)
+    user = get_user(message.from_user.id)
+    if user and user['role'] == 'سائق':
+        live_locations.update(message.from_user.id, message.location.latitude, message.location.longitude)
 
+@conversation_step
 def get_destination_with_location(message, start_location):
     telegram_id = message.from_user.id
-    msg = bot.send_message(message.chat.id, "أدخل السعر بالأرقام:")
-    bot.register_next_step_handler(msg, get_price_with_location, start_location, message.text)
+    send_message(message.chat.id, "أدخل السعر بالأرقام:")
+    set_next_step(message.chat.id, get_price_with_location, start_location=start_location, destination=message.text)
 
+@conversation_step
 def get_price_with_location(message, start_location, destination):
     telegram_id = message.from_user.id
     user = get_user(telegram_id)
     try:
         price = float(message.text)
     except:
-        msg = bot.send_message(message.chat.id, "ادخل رقم صالح للسعر:")
-        bot.register_next_step_handler(msg, get_price_with_location, start_location, destination)
+        send_message(message.chat.id, "ادخل رقم صالح للسعر:")
+        set_next_step(message.chat.id, get_price_with_location, start_location=start_location, destination=destination)
         return
     trip = {
         "passenger_id": telegram_id,
@@ -396,138 +2449,460 @@ def get_price_with_location(message, start_location, destination):
         "price": price,
         "driver_id": None
     }
-    add_trip(trip)
-    bot.send_message(message.chat.id, "🛺 تم ارسال الرحلة! في انتظار أقرب سائق متاح ومتوافق.")
+    trip["trip_id"] = add_trip(trip)
+    zone_stats.record(start_location, "requests", price)
+    send_message(message.chat.id, "🛺 تم ارسال الرحلة! في انتظار أقرب سائق متاح ومتوافق.")
     assign_driver(trip)
 
+@instrumented("bot_dispatch_seconds", label="step")
 def assign_driver(trip):
-    min_dist = float('inf')
-    selected_driver = None
-    drivers = get_all_available_drivers(trip["gender"], 2)
-    for driver in drivers:
-        driver_id, lat, lon = driver
-        d = distance((lat, lon), trip["start"])
-        if d < min_dist:
-            min_dist = d
-            selected_driver = driver_id
-    if selected_driver:
-        # ضبط السائق في الرحلة
-        conn = db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            UPDATE trips SET driver_id = ? WHERE passenger_id = ?
-        """, (selected_driver, trip["passenger_id"]))
-        conn.commit()
-        conn.close()
-        lat, lon = trip["start"]
-        link = f"https://www.google.com/maps?q={lat},{lon}"
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-        markup.add('/قبول ✅','/رفض ❌')
-        bot.send_message(selected_driver, f"🚨 رحلة جديدة:\nالراكب: {trip['passenger_name']}\nالموقع: {link}\nالوجهة: {trip['destination']}\nالسعر: {trip['price']} دينار", reply_markup=markup)
-    else:
-        bot.send_message(trip["passenger_id"], "❌ لا يوجد سائق متوفر حاليًا، حاول لاحقًا.")
+    if DISPATCH_MODE == "batch":
+        batch_dispatcher.submit(trip)
+        return
+    started = time.perf_counter()
+    candidates = rank_candidates(trip)
+    matches = [(trip, candidates[0][1], candidates[0][0])] if candidates else []
+    dispatch_metrics.record(1, matches, time.perf_counter() - started)
+    trip_offers.start(trip, [driver_id for _, driver_id in candidates])
+
+@instrumented("bot_dispatch_seconds", label="step")
+def offer_trip(trip, driver_id):
+    lat, lon = trip["start"]
+    link = f"https://www.google.com/maps?q={lat},{lon}"
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+    markup.add('/قبول ✅','/رفض ❌')
+    send_message(driver_id, f"🚨 رحلة جديدة:\nالراكب: {trip['passenger_name']}\nالموقع: {link}\nالوجهة: {trip['destination']}\nالسعر: {trip['price']} دينار", PRIORITY_TRIP, reply_markup=markup)
+
+def notify_no_driver(trip):
+    send_message(trip["passenger_id"], "❌ لا يوجد سائق متوفر حاليًا، حاول لاحقًا.", PRIORITY_TRIP)
 
 def handle_trip_response(driver_id, response):
-    trip = get_trip_for_driver(driver_id)
+    # عرض قائم للسائق، وإلا الرحلة التي قبلها سابقًا
+    trip_id = trip_offers.offered_trip(driver_id)
+    trip = {"trip_id": trip_id} if trip_id is not None else get_trip_for_driver(driver_id)
     if not trip:
-        bot.send_message(driver_id, "❌ لا توجد رحلة لتتعامل معها.")
+        send_message(driver_id, "❌ لا توجد رحلة لتتعامل معها.")
         return
     if response == '/قبول ✅':
-        bot.send_message(driver_id, "✅ لقد قبلت الرحلة! سيتم تحديث الرصيد بعد انتهاء الرحلة.")
+        if trip_id is not None:
+            trip = trip_offers.accept(driver_id, trip_id)
+            if not trip:
+                send_message(driver_id, "⌛ الرحلة لم تعد متاحة.", PRIORITY_TRIP, reply_markup=types.ReplyKeyboardRemove())
+                return
+        send_message(driver_id, "✅ لقد قبلت الرحلة! سيتم تحديث الرصيد بعد انتهاء الرحلة.", PRIORITY_TRIP)
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
         markup.add('تم استلام الراكب 🚶')
-        bot.send_message(driver_id, "اضغط عند استلام الراكب:", reply_markup=markup)
+        send_message(driver_id, "اضغط عند استلام الراكب:", PRIORITY_TRIP, reply_markup=markup)
         passenger_id = trip["passenger_id"]
         user = get_user(driver_id)
-        bot.send_message(passenger_id, f"🚖 سائق {user['gender']} قبل الرحلة وسيصل إليك قريبًا.")
+        send_message(passenger_id, f"🚖 سائق {user['gender']} قبل الرحلة وسيصل إليك قريبًا.", PRIORITY_TRIP)
     elif response == '/رفض ❌':
-        bot.send_message(driver_id, "❌ لقد رفضت الرحلة.")
-        conn = db_connection()
-        cur = conn.cursor()
-        cur.execute("UPDATE trips SET driver_id = NULL WHERE id = ?", (trip["trip_id"],))
-        conn.commit()
-        conn.close()
-        assign_driver({
-            "passenger_id": trip["passenger_id"],
-            "passenger_name": "",
-            "gender": "",
-            "start": (0,0),
-            "destination": "",
-            "price": 0
-        })
-
-@bot.message_handler(func=lambda message: get_user(message.from_user.id) and get_user(message.from_user.id).get("role") == 'أدمن')
-def admin_actions(message):
-    user = get_user(message.from_user.id)
-    if not user or not user.get("admin"):
-        bot.send_message(message.chat.id, "ليس لديك صلاحية الأدمن.")
+        send_message(driver_id, "❌ لقد رفضت الرحلة.", PRIORITY_TRIP)
+        if trip_id is not None:
+            trip_offers.reject(driver_id, trip_id)
+            return
+        # السائق قبل الرحلة ثم تراجع: ترتيب جديد من موقعها الحقيقي
+        with db_transaction() as conn:
+            conn.execute("UPDATE trips SET driver_id = NULL, accepted_at = NULL WHERE id = ? AND driver_id = ?", (trip["trip_id"], driver_id))
+            record_trip_event(trip["trip_id"], "released", driver_id)
+        full_trip = get_trip(trip["trip_id"])
+        if full_trip:
+            trip_offers.start(full_trip, [d for _, d in rank_candidates(full_trip, exclude={driver_id})])
+
+@route('أدمن', 'عرض بيانات مستخدم 👤', priority=PRIORITY_NORMAL)
+@admin_only
+def admin_user_info(ctx):
+    send_message(ctx.chat_id, "ادخل @username:")
+    set_next_step(ctx.chat_id, admin_show_user)
+
+@route('أدمن', 'إضافة رصيد ➕', priority=PRIORITY_NORMAL)
+@admin_only
+def admin_add_balance_start(ctx):
+    send_message(ctx.chat_id, "ادخل @username للسائق:")
+    set_next_step(ctx.chat_id, admin_add_balance)
+
+@route('أدمن', 'خصم رصيد ➖', priority=PRIORITY_NORMAL)
+@admin_only
+def admin_subtract_balance_start(ctx):
+    send_message(ctx.chat_id, "ادخل @username للسائق:")
+    set_next_step(ctx.chat_id, admin_subtract_balance)
+
+@route('أدمن', 'إحصائيات المناطق 📊', priority=PRIORITY_NORMAL)
+@admin_only
+def admin_zone_stats(ctx):
+    zones = zone_stats.top_zones()
+    if not zones:
+        send_message(ctx.chat_id, "📊 لا توجد بيانات للمناطق بعد.")
         return
-    text = message.text
-    if text == 'عرض بيانات مستخدم 👤':
-        msg = bot.send_message(message.chat.id, "ادخل @username:")
-        bot.register_next_step_handler(msg, admin_show_user)
-    elif text == 'إضافة رصيد ➕':
-        msg = bot.send_message(message.chat.id, "ادخل @username للسائق:")
-        bot.register_next_step_handler(msg, admin_add_balance)
-    elif text == 'خصم رصيد ➖':
-        msg = bot.send_message(message.chat.id, "ادخل @username للسائق:")
-        bot.register_next_step_handler(msg, admin_subtract_balance)
-    else:
-        show_menu(message, 'أدمن')
+    lines = [f"📊 أنشط المناطق (آخر {ZONE_WINDOW / 60:g} دقيقة):"]
+    for zone, summary in zones:
+        lat, lon = zone_stats.zone_center(zone)
+        flag = " ⚠️" if summary["drivers"] == 0 or summary["requests"] > summary["drivers"] * ZONE_DEMAND_RATIO else ""
+        lines.append(
+            f"📍 {lat:.3f},{lon:.3f}{flag}\n"
+            f"طلبات: {summary['requests']} | مطابقة: {summary['matches']} | رفض: {summary['rejections']} | بلا سائق: {summary['unmatched']}\n"
+            f"متوسط السعر: {summary['average_price']:.1f} دينار | سائقون متوفرون: {summary['drivers']}"
+        )
+    send_message(ctx.chat_id, "\n\n".join(lines))
+    show_menu(ctx.message, 'أدمن')
 
+@role_default('أدمن')
+@admin_only
+def admin_menu(ctx):
+    show_menu(ctx.message, 'أدمن')
+
+@conversation_step
 def admin_show_user(message):
     username = message.text.strip().lstrip('@').lower()
     user = get_user_by_username(username)
     if user:
         balance = user.get("balance", 0)
-        avg = sum(user.get("ratings", []))/len(user.get("ratings", [])) if user.get("ratings") else 0
-        bot.send_message(message.chat.id, f"👤 بيانات المستخدم:\nدور: {user['role']}\nجنس: {user.get('gender', 'غير محدد')}\nرصيد: {balance}\nمتوسط تقييم: {avg:.1f}")
+        avg = get_rating_summary(user["telegram_id"])["average"]
+        send_message(message.chat.id, f"👤 بيانات المستخدم:\nدور: {user['role']}\nجنس: {user.get('gender', 'غير محدد')}\nرصيد: {balance}\nمتوسط تقييم: {avg:.1f}")
     else:
-        bot.send_message(message.chat.id, "❌ المستخدم غير موجود بالـ username.")
+        send_message(message.chat.id, "❌ المستخدم غير موجود بالـ username.")
     show_menu(message, 'أدمن')
 
+@conversation_step
 def admin_add_balance(message):
     username = message.text.strip().lstrip('@').lower()
     user = get_user_by_username(username)
     if user:
-        msg = bot.send_message(message.chat.id, "ادخل قيمة الرصيد المراد إضافتها:")
-        bot.register_next_step_handler(msg, lambda m: admin_add_balance_value(user["telegram_id"], m))
+        send_message(message.chat.id, "ادخل قيمة الرصيد المراد إضافتها:")
+        set_next_step(message.chat.id, admin_add_balance_value, user_id=user["telegram_id"])
     else:
-        bot.send_message(message.chat.id, "❌ المستخدم غير موجود بالـ username.")
+        send_message(message.chat.id, "❌ المستخدم غير موجود بالـ username.")
         show_menu(message, 'أدمن')
 
-def admin_add_balance_value(user_id, message):
+@conversation_step
+def admin_add_balance_value(message, user_id):
     try:
         amount = float(message.text)
-        user = get_user(user_id)
-        new_balance = float(user["balance"]) + amount
-        update_user_field(user_id, "balance", new_balance)
-        bot.send_message(user_id, f"💰 تم إضافة {amount} دينار لرصيدك. الرصيد الجديد: {new_balance}")
-        bot.send_message(message.chat.id, f"✅ تم إضافة {amount} دينار للمستخدم. الرصيد الجديد: {new_balance}")
+        new_balance = post_ledger_entry(user_id, amount, f"admin_add:{message.from_user.id}")
+        if new_balance is None:
+            raise ValueError(user_id)
+        send_message(user_id, f"💰 تم إضافة {amount} دينار لرصيدك. الرصيد الجديد: {new_balance}")
+        send_message(message.chat.id, f"✅ تم إضافة {amount} دينار للمستخدم. الرصيد الجديد: {new_balance}")
     except:
-        bot.send_message(message.chat.id, "❌ قيمة غير صالحة.")
+        send_message(message.chat.id, "❌ قيمة غير صالحة.")
     show_menu(message, 'أدمن')
 
+@conversation_step
 def admin_subtract_balance(message):
     username = message.text.strip().lstrip('@').lower()
     user = get_user_by_username(username)
     if user:
-        msg = bot.send_message(message.chat.id, "ادخل قيمة الرصيد المراد خصمها:")
-        bot.register_next_step_handler(msg, lambda m: admin_subtract_balance_value(user["telegram_id"], m))
+        send_message(message.chat.id, "ادخل قيمة الرصيد المراد خصمها:")
+        set_next_step(message.chat.id, admin_subtract_balance_value, user_id=user["telegram_id"])
     else:
-        bot.send_message(message.chat.id, "❌ المستخدم غير موجود بالـ username.")
+        send_message(message.chat.id, "❌ المستخدم غير موجود بالـ username.")
         show_menu(message, 'أدمن')
 
-def admin_subtract_balance_value(user_id, message):
+@conversation_step
+def admin_subtract_balance_value(message, user_id):
     try:
         amount = float(message.text)
-        user = get_user(user_id)
-        new_balance = float(user["balance"]) - amount
-        update_user_field(user_id, "balance", new_balance)
-        bot.send_message(user_id, f"💸 تم خصم {amount} دينار من رصيدك. الرصيد الجديد: {new_balance}")
-        bot.send_message(message.chat.id, f"✅ تم خصم {amount} دينار من المستخدم. الرصيد الجديد: {new_balance}")
+        new_balance = post_ledger_entry(user_id, -amount, f"admin_subtract:{message.from_user.id}")
+        if new_balance is None:
+            raise ValueError(user_id)
+        send_message(user_id, f"💸 تم خصم {amount} دينار من رصيدك. الرصيد الجديد: {new_balance}")
+        send_message(message.chat.id, f"✅ تم خصم {amount} دينار من المستخدم. الرصيد الجديد: {new_balance}")
     except:
-        bot.send_message(message.chat.id, "❌ قيمة غير صالحة.")
+        send_message(message.chat.id, "❌ قيمة غير صالحة.")
     show_menu(message, 'أدمن')
 
-bot.infinity_polling()
\ No newline at end of file
+# =================== جدولة التحديثات ===================
+# طابور محدود بأولويات: الرحلات > المدفوعات والأدمن > القوائم. تحديثات المحادثة الواحدة تُعالج
+# بالترتيب وعلى خيط واحد في كل لحظة؛ عند الازدحام تُرفض تحديثات القوائم برسالة "مشغول"
+
+def update_priority(update):
+    if update.edited_message is not None:
+        # تحديثات الموقع المباشر: التالي يحل محل السابق، فلا بأس بإسقاطها
+        return PRIORITY_MENU
+    message = update.message
+    if message is None:
+        return PRIORITY_NORMAL
+    key = message.text if message.content_type == 'text' else ("content", message.content_type)
+    # نص غير معروف غالبًا إدخال في محادثة (سعر، وجهة، مبلغ، تقييم)
+    return ROUTE_PRIORITIES.get(key, PRIORITY_NORMAL)
+
+def update_chat_id(update):
+    message = update.message or update.edited_message
+    return message.chat.id if message is not None else None
+
+class UpdateScheduler:
+    def __init__(self, workers=UPDATE_WORKERS, max_pending=UPDATE_QUEUE_SIZE, shed_at=UPDATE_SHED_AT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.shed_at = max(1, int(max_pending * shed_at))
+        self.cond = threading.Condition()
+        # كومة (أولوية، تسلسل، محادثة): تنبيه بأن للمحادثة تحديثات جاهزة (قد تتكرر؛ الزائد يُتجاهل)
+        self.ready = []
+        # المحادثة -> طابور تحديثاتها بالترتيب
+        self.chats = {}
+        self.busy = set()
+        self.pending = 0
+        self.seq = 0
+        self.threads = []
+        self.depth = {PRIORITY_TRIP: 0, PRIORITY_NORMAL: 0, PRIORITY_MENU: 0}
+
+    def __len__(self):
+        return self.pending
+
+    def start(self):
+        with self.cond:
+            if not self.threads:
+                for i in range(self.workers):
+                    t = threading.Thread(target=self._worker, name=f"update-worker-{i}", daemon=True)
+                    t.start()
+                    self.threads.append(t)
+
+    def submit(self, update, block=True):
+        # False إذا رُفض التحديث (أُسقط لأنه منخفض الأولوية، أو الطابور ممتلئ و block=False)
+        priority = update_priority(update)
+        with self.cond:
+            if priority == PRIORITY_MENU and self.pending >= self.shed_at:
+                shed = True
+            else:
+                shed = False
+                while self.pending >= self.max_pending:
+                    if not block:
+                        metrics.inc("bot_updates_rejected_total", priority=priority)
+                        return False
+                    self.cond.wait()
+                self.seq += 1
+                chat_id = update_chat_id(update)
+                if chat_id is None:
+                    # بدون محادثة: مفتاح خاص لكل تحديث
+                    chat_id = ("update", self.seq)
+                self.chats.setdefault(chat_id, deque()).append((priority, self.seq, time.monotonic(), update))
+                self.pending += 1
+                self.depth[priority] += 1
+                if chat_id not in self.busy:
+                    heapq.heappush(self.ready, (priority, self.seq, chat_id))
+                self.cond.notify()
+        if shed:
+            metrics.inc("bot_updates_shed_total", priority=priority)
+            if update.message is not None:
+                send_message(update.message.chat.id, "⏳ البوت مشغول حاليًا، حاول مرة أخرى بعد قليل.", PRIORITY_MENU)
+            return False
+        return True
+
+    def _next(self):
+        with self.cond:
+            while True:
+                while not self.ready:
+                    self.cond.wait()
+                _, _, chat_id = heapq.heappop(self.ready)
+                if chat_id in self.busy or not self.chats.get(chat_id):
+                    continue
+                self.busy.add(chat_id)
+                return chat_id, self.chats[chat_id].popleft()
+
+    def _done(self, chat_id, priority):
+        with self.cond:
+            self.busy.discard(chat_id)
+            self.pending -= 1
+            self.depth[priority] -= 1
+            waiting = self.chats.get(chat_id)
+            if waiting:
+                # المحادثة تأخذ أعلى أولوية بين تحديثاتها المنتظرة حتى لا يعلق تحديث رحلة خلف قائمة
+                heapq.heappush(self.ready, (min(item[0] for item in waiting), waiting[0][1], chat_id))
+            else:
+                self.chats.pop(chat_id, None)
+            self.cond.notify_all()
+
+    def _worker(self):
+        while True:
+            chat_id, (priority, _, queued_at, update) = self._next()
+            metrics.histogram("bot_update_wait_seconds", priority=priority).observe(time.monotonic() - queued_at)
+            try:
+                bot.process_now([update])
+            except Exception:
+                telebot.logger.exception("update failed")
+            finally:
+                self._done(chat_id, priority)
+
+update_scheduler = UpdateScheduler()
+
+def start_update_scheduler():
+    bot.threaded = False
+    bot.scheduler = update_scheduler
+    update_scheduler.start()
+
+# =================== استقبال التحديثات ===================
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_error(404)
+            return
+        if WEBHOOK_SECRET and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            self.send_error(403)
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            update = types.Update.de_json(json.loads(body))
+        except ValueError:
+            self.send_error(400)
+            return
+        if not update_scheduler.submit(update, block=False) and update_priority(update) != PRIORITY_MENU:
+            # الطابور ممتلئ: تيليجرام يعيد إرسال التحديث لاحقًا (تحديثات القوائم المرفوضة تم الرد عليها)
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def start_webhook_server(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT):
+    # خادم HTTP يستقبل التحديثات ويسلمها لمجدول التحديثات
+    start_update_scheduler()
+    server = ThreadingHTTPServer((listen, port), WebhookHandler)
+    server.daemon_threads = True
+    if WEBHOOK_SSL_CERT and WEBHOOK_SSL_KEY:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(WEBHOOK_SSL_CERT, WEBHOOK_SSL_KEY)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, name="webhook-server", daemon=True).start()
+    return server
+
+def run_webhook():
+    server = start_webhook_server()
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        certificate = open(WEBHOOK_SSL_CERT, "rb") if WEBHOOK_SSL_CERT else None
+        bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, certificate=certificate, secret_token=WEBHOOK_SECRET or None)
+    try:
+        while True:
+            time.sleep(3600)
+    finally:
+        server.shutdown()
+
+# =================== نقطة القياسات ===================
+
+def instrument_handlers():
+    # تغليف كل معالج رسائل وفلتره بمؤقت (مرة واحدة فقط)
+    for handlers in (bot.message_handlers, bot.edited_message_handlers):
+        for handler in handlers:
+            if handler.get("instrumented"):
+                continue
+            handler["instrumented"] = True
+            name = handler["function"].__name__
+            handler["function"] = instrumented("bot_handler_seconds", name, "handler")(handler["function"])
+            if handler["filters"].get("func"):
+                handler["filters"]["func"] = instrumented("bot_filter_seconds", name, "handler")(handler["filters"]["func"])
+
+def thread_counts():
+    counts = {}
+    for thread in threading.enumerate():
+        kind = re.sub(r"[-_]?\d+", "", thread.name)
+        counts[(("kind", kind),)] = counts.get((("kind", kind),), 0) + 1
+    return counts
+
+metrics.gauge("bot_threads", threading.active_count, "live threads")
+metrics.gauge("bot_threads_by_kind", thread_counts)
+metrics.gauge("bot_outbound_queue_depth", lambda: len(outbound))
+metrics.gauge("bot_outbound_sent", lambda: outbound.sent)
+metrics.gauge("bot_outbound_failed", lambda: outbound.failed)
+metrics.gauge("bot_update_queue_depth", lambda: {(("priority", p),): n for p, n in update_scheduler.depth.items()},
+              "updates waiting or running, by priority (0 = trips, 1 = payments/admin, 2 = menus)")
+metrics.gauge("bot_batch_dispatch_pending", lambda: len(batch_dispatcher))
+metrics.gauge("bot_gps_active_drivers", lambda: len(gps_scheduler), "drivers with scheduled GPS updates")
+metrics.gauge("bot_live_location_drivers", lambda: len(live_locations), "drivers sharing a live location")
+metrics.gauge("bot_available_drivers", lambda: len(driver_index))
+metrics.gauge("bot_open_offers", lambda: len(trip_offers), "trips waiting for a driver's answer")
+metrics.gauge("bot_timers_pending", lambda: len(timers))
+metrics.gauge("bot_user_cache", lambda: {(("stat", k),): v for k, v in user_cache.stats().items()})
+metrics.gauge("bot_dispatch", lambda: {(("stat", k),): v for k, v in dispatch_metrics.stats().items()})
+metrics.gauge("bot_db_statements", lambda: db_statements)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path == "/metrics":
+            self.reply(metrics.render(), "text/plain; version=0.0.4")
+        elif url.path == "/profile/start":
+            started = profiler.start(float(params["interval"]) if "interval" in params else None)
+            self.reply("started\n" if started else "already running\n")
+        elif url.path == "/profile/stop":
+            profiler.stop()
+            self.reply("stopped\n")
+        elif url.path == "/profile":
+            self.reply(profiler.report(int(params.get("limit", 200))))
+        elif url.path == "/trips/export" and EXPORT_TOKEN:
+            self.stream_export(params.get("format", "csv"), params.get("since", "0"))
+        else:
+            self.send_error(404)
+
+    def stream_export(self, fmt, since):
+        # الأرشيف فيه أسماء الركاب ومواقعهم: التصدير يتطلب Authorization: Bearer <EXPORT_TOKEN>
+        if not hmac.compare_digest(self.headers.get("Authorization", "").encode(), f"Bearer {EXPORT_TOKEN}".encode()):
+            self.send_error(403)
+            return
+        if fmt not in ("csv", "jsonl"):
+            self.send_error(400, "format must be csv or jsonl")
+            return
+        try:
+            since = float(since)
+        except ValueError:
+            since = math.nan
+        if not math.isfinite(since):
+            self.send_error(400, "since must be a unix timestamp")
+            return
+        # بدون Content-Length: الاستجابة تنتهي بإغلاق الاتصال، وكل دفعة تُكتب فور تجهيزها.
+        # كل طلب في خيط جديد، فالاتصال خاص بالطلب ويُغلق معه بدل اتصال الخيط الذي لا يُغلق أبدًا
+        conn = open_db_connection()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson; charset=utf-8")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for chunk in export_trip_history(fmt, since, conn=conn):
+                self.wfile.write(chunk.encode())
+        finally:
+            conn.close()
+
+    def reply(self, text, content_type="text/plain"):
+        body = text.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(listen=METRICS_LISTEN, port=METRICS_PORT):
+    server = ThreadingHTTPServer((listen, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+def setup():
+    initialize_db()
+    load_driver_index()
+    trip_offers.recover()
+    instrument_handlers()
+    if METRICS_PORT:
+        start_metrics_server()
+    if BALANCE_SNAPSHOT_INTERVAL:
+        timers.every(BALANCE_SNAPSHOT_INTERVAL, snapshot_balances)
+    timers.every(LIVE_FLUSH_INTERVAL, live_locations.flush)
+
+def run_bot():
+    if not API_TOKEN:
+        raise SystemExit("TELEGRAM_API_TOKEN is not set")
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        start_update_scheduler()
+        bot.infinity_polling()
+
+if __name__ == "__main__":
+    setup()
+    run_bot()
\ No newline at end of file
@@ -0,0 +1,55 @@
+import types
+
+import pytest
+
+import main
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def store(request, db):
+    if request.param == "memory":
+        return main.MemoryConversationStore()
+    return main.SQLiteConversationStore()
+
+
+def test_pop_resumes_once(store):
+    store.set(1, "get_destination", {"lat": 1.5})
+    assert store.pop(1) == ("get_destination", {"lat": 1.5})
+    assert store.pop(1) is None
+
+
+def test_expired_step_is_dropped(store, monkeypatch):
+    store.set(1, "get_destination", {})
+    monkeypatch.setattr(main, "CONVERSATION_TTL", -1)
+    assert store.pop(1) is None
+    monkeypatch.undo()
+    assert store.pop(1) is None
+
+
+def test_message_without_step_takes_no_write_lock(db, monkeypatch):
+    monkeypatch.setattr(main, "conversations", main.SQLiteConversationStore())
+    # كاتب آخر يحجز قفل الكتابة؛ رسالة بلا خطوة معلقة يجب ألا تنتظره
+    writer = main.open_db_connection()
+    writer.execute("BEGIN IMMEDIATE")
+    statements = []
+    db.set_trace_callback(statements.append)
+    try:
+        message = types.SimpleNamespace(chat=types.SimpleNamespace(id=1))
+        assert not main.resume_conversation(message)
+    finally:
+        db.set_trace_callback(None)
+        writer.execute("ROLLBACK")
+        writer.close()
+    assert [statement.split()[0] for statement in statements] == ["SELECT"]
+    assert not db.in_transaction
+
+
+def test_resume_runs_step(db, monkeypatch):
+    monkeypatch.setattr(main, "conversations", main.SQLiteConversationStore())
+    calls = []
+    monkeypatch.setitem(main.STEP_HANDLERS, "recorded_step", lambda message, **data: calls.append(data))
+    main.conversations.set(1, "recorded_step", {"price": 5})
+    message = types.SimpleNamespace(chat=types.SimpleNamespace(id=1))
+    assert main.resume_conversation(message)
+    assert calls == [{"price": 5}]
+    assert not main.resume_conversation(message)
@@ -0,0 +1,34 @@
+import threading
+
+import main
+
+
+def test_close_leaves_other_threads_connections_to_their_owner(db):
+    opened = threading.Event()
+    closed = threading.Event()
+    connections = []
+
+    def worker():
+        connections.append(main.db_connection())
+        opened.set()
+        closed.wait(5)
+        # الاتصال ما زال صالحًا حتى يطلب صاحبه اتصالًا جديدًا
+        connections[0].execute("SELECT 1").fetchone()
+        connections.append(main.db_connection())
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    assert opened.wait(5)
+    main.close_db_connections()
+    closed.set()
+    thread.join(5)
+    assert connections[0] is not connections[1]
+    assert connections[0] not in main._db_connections
+    assert connections[1] in main._db_connections
+
+
+def test_close_inside_transaction_keeps_connection_until_commit(db):
+    with main.db_transaction() as conn:
+        main.close_db_connections()
+        assert main.db_connection() is conn
+    assert main.db_connection() is not conn
@@ -0,0 +1,75 @@
+import random
+
+import pytest
+
+import main
+
+GENDERS = ("ذكر", "أنثى")
+
+
+def brute_force(drivers, loc, k, gender, min_balance, max_km):
+    found = []
+    for driver_id, (lat, lon, driver_gender, balance) in drivers.items():
+        d = main.distance((lat, lon), loc)
+        if (gender is None or driver_gender == gender) and balance >= min_balance and d <= max_km:
+            found.append((d, driver_id))
+    return sorted(found)[:k]
+
+
+@pytest.fixture(params=[
+    # مدينة كثيفة: البحث الحلقي
+    {"cell_deg": 0.01, "center": (32.88, 13.19), "spread": 0.1, "count": 400},
+    # سائقون متفرقون على مساحة واسعة: فحص الخلايا المشغولة
+    {"cell_deg": 0.01, "center": (30.0, 17.0), "spread": 6.0, "count": 60},
+    # خلايا كبيرة قرب خط الاستواء وعبر خط الطول صفر
+    {"cell_deg": 0.5, "center": (0.1, 0.0), "spread": 2.0, "count": 200},
+], ids=["dense", "sparse", "equator"])
+def populated(request):
+    rng = random.Random(7)
+    index = main.DriverIndex(cell_deg=request.param["cell_deg"])
+    lat0, lon0 = request.param["center"]
+    spread = request.param["spread"]
+    drivers = {}
+    for driver_id in range(request.param["count"]):
+        lat = lat0 + rng.uniform(-spread, spread)
+        lon = lon0 + rng.uniform(-spread, spread)
+        drivers[driver_id] = (lat, lon, rng.choice(GENDERS), rng.choice((0, 1, 2, 5, 10)))
+        index.upsert(driver_id, *drivers[driver_id])
+    yield index, drivers, request.param, rng
+    for driver_id in drivers:
+        index.remove(driver_id)
+
+
+def test_nearest_matches_brute_force(populated):
+    index, drivers, params, rng = populated
+    lat0, lon0 = params["center"]
+    spread = params["spread"]
+    for _ in range(60):
+        loc = (lat0 + rng.uniform(-1.5 * spread, 1.5 * spread), lon0 + rng.uniform(-1.5 * spread, 1.5 * spread))
+        k = rng.choice((1, 3, 10, 50))
+        gender = rng.choice((None,) + GENDERS)
+        min_balance = rng.choice((0, 2, 5))
+        max_km = rng.choice((float("inf"), 1, 5, 50, 300))
+        expected = brute_force(drivers, loc, k, gender, min_balance, max_km)
+        assert index.nearest(loc, k, gender, min_balance, max_km) == expected, (loc, k, gender, min_balance, max_km)
+
+
+def test_nearest_follows_moves_and_removals(populated):
+    index, drivers, params, rng = populated
+    lat0, lon0 = params["center"]
+    for driver_id in list(drivers)[:20]:
+        if driver_id % 2:
+            index.remove(driver_id)
+            del drivers[driver_id]
+        else:
+            lat, lon, gender, balance = drivers[driver_id]
+            lat, lon = lat + rng.uniform(-0.2, 0.2), lon + rng.uniform(-0.2, 0.2)
+            assert index.move(driver_id, lat, lon)
+            drivers[driver_id] = (lat, lon, gender, balance)
+    loc = (lat0, lon0)
+    assert index.nearest(loc, 25) == brute_force(drivers, loc, 25, None, 0, float("inf"))
+    assert not index.move(1, lat0, lon0)
+
+
+def test_empty_index():
+    assert main.DriverIndex().nearest((32.88, 13.19), 5) == []
@@ -0,0 +1,61 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+import main
+
+TOKEN = "secret"
+
+
+@pytest.fixture
+def server(db, monkeypatch):
+    monkeypatch.setattr(main, "EXPORT_TOKEN", TOKEN)
+    trip = {"passenger_id": 100, "passenger_name": "p", "gender": "ذكر", "start": (32.88, 13.19),
+            "destination": "x", "price": 10}
+    main.archive_trip(main.add_trip(trip), "completed")
+    server = main.start_metrics_server("127.0.0.1", 0)
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def get(url, token=TOKEN):
+    request = urllib.request.Request(url, headers={"Authorization": f"Bearer {token}"} if token else {})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, ""
+
+
+def test_export_streams_archive(server):
+    status, body = get(server + "/trips/export?format=jsonl")
+    assert status == 200
+    assert '"status": "completed"' in body
+    status, body = get(server + "/trips/export")
+    assert body.splitlines()[0] == ",".join(main.TRIP_HISTORY_COLUMNS)
+    assert len(body.splitlines()) == 2
+
+
+def test_export_requires_token(server):
+    assert get(server + "/trips/export", token=None)[0] == 403
+    assert get(server + "/trips/export", token="wrong")[0] == 403
+
+
+def test_export_disabled_without_token(server, monkeypatch):
+    monkeypatch.setattr(main, "EXPORT_TOKEN", "")
+    assert get(server + "/trips/export")[0] == 404
+    assert get(server + "/metrics")[0] == 200
+
+
+@pytest.mark.parametrize("query", ["since=yesterday", "since=nan", "format=xml"])
+def test_export_rejects_bad_params(server, query):
+    assert get(server + "/trips/export?" + query)[0] == 400
+
+
+def test_export_closes_its_connection(server):
+    before = len(main._db_connections)
+    for _ in range(10):
+        assert get(server + "/trips/export")[0] == 200
+    assert len(main._db_connections) == before
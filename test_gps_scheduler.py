@@ -0,0 +1,40 @@
+import time
+
+import main
+
+
+class RecordingScheduler(main.GpsScheduler):
+    def __init__(self):
+        super().__init__(interval=0.05, slack=0)
+        self.ticks = []
+
+    def tick(self, driver_ids):
+        self.ticks.append(list(driver_ids))
+        return set(driver_ids)
+
+
+def test_toggling_keeps_one_entry_per_driver():
+    scheduler = RecordingScheduler()
+    for _ in range(5):
+        assert scheduler.add(1)
+        scheduler.discard(1)
+    assert scheduler.add(1)
+    assert not scheduler.add(1)
+    time.sleep(0.4)
+    with scheduler.cond:
+        ticks = list(scheduler.ticks)
+        live = [entry for entry in scheduler.heap if scheduler.active.get(entry[1]) == entry[0]]
+    assert ticks
+    assert all(tick == [1] for tick in ticks)
+    assert len(live) == 1
+
+
+def test_discarded_driver_is_not_ticked():
+    scheduler = RecordingScheduler()
+    scheduler.add(1)
+    scheduler.add(2)
+    scheduler.discard(1)
+    time.sleep(0.2)
+    assert scheduler.ticks
+    assert all(tick == [2] for tick in scheduler.ticks)
+    assert len(scheduler) == 1
@@ -0,0 +1,40 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def driver(db):
+    main.set_user(1, "driver", "سائق", "ذكر", balance=10)
+    main.driver_index.upsert(1, 32.88, 13.19, "ذكر", 10)
+    yield 1
+    main.driver_index.remove(1)
+    main.user_cache.invalidate(1)
+
+
+def index_balance(driver_id):
+    return main.driver_index.drivers[driver_id]["balance"]
+
+
+def test_rollback_leaves_cache_and_index_untouched(db, driver):
+    with pytest.raises(RuntimeError):
+        with main.db_transaction():
+            assert main.post_ledger_entry(driver, -2, "commission") == 8
+            raise RuntimeError("archive failed")
+    assert db.execute("SELECT balance FROM users WHERE telegram_id = ?", (driver,)).fetchone()[0] == 10
+    assert main.get_user(driver)["balance"] == 10
+    assert index_balance(driver) == 10
+
+
+def test_cache_and_index_follow_outer_commit(db, driver):
+    with main.db_transaction():
+        main.post_ledger_entry(driver, -2, "commission")
+        assert main.get_user(driver)["balance"] == 10
+    assert main.get_user(driver)["balance"] == 8
+    assert index_balance(driver) == 8
+
+
+def test_standalone_entry_applies_immediately(db, driver):
+    assert main.post_ledger_entries([(driver, 5, "top_up")]) == {driver: 15}
+    assert main.get_user(driver)["balance"] == 15
+    assert index_balance(driver) == 15
@@ -0,0 +1,54 @@
+import types
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    messages = []
+    monkeypatch.setattr(main, "send_message", lambda chat_id, text, *args, **kwargs: messages.append((chat_id, text)))
+    return messages
+
+
+@pytest.fixture
+def driver(db, sent):
+    main.set_user(1, "driver", "سائق", "ذكر", balance=10)
+    main.set_driver_status(1, 'متوفر', 32.88, 13.19)
+    yield 1
+    main.set_driver_status(1, 'مشغول')
+    main.user_cache.invalidate(1)
+
+
+def location_ctx(driver_id, live_period=None):
+    location = types.SimpleNamespace(latitude=32.9, longitude=13.2, live_period=live_period)
+    return types.SimpleNamespace(user_id=driver_id, chat_id=driver_id, message=types.SimpleNamespace(location=location))
+
+
+def driver_status(db, driver_id):
+    return db.execute("SELECT status FROM driver_status WHERE driver_id = ?", (driver_id,)).fetchone()[0]
+
+
+def test_static_pin_does_not_start_live_tracking(driver, sent):
+    main.driver_location(location_ctx(driver))
+    assert driver not in main.live_locations
+    assert driver in main.driver_index.drivers
+    assert sent[-1] == (driver, "📍 شارك موقعك المباشر (وليس موقعًا ثابتًا) ليصلك أقرب الركاب.")
+
+
+def test_live_location_starts_tracking(driver, sent):
+    main.driver_location(location_ctx(driver, live_period=900))
+    assert driver in main.live_locations
+    assert sent[-1] == (driver, "📍 تم تفعيل الموقع المباشر.")
+    assert main.driver_index.drivers[driver]["lat"] == 32.9
+
+
+def test_stale_driver_becomes_busy_and_is_told(db, driver, sent):
+    live = main.LiveLocations(stale_after=-1)
+    assert live.update(driver, 32.9, 13.2)
+    assert live.flush() == (1, 1)
+    assert driver not in main.driver_index.drivers
+    assert driver_status(db, driver) == 'مشغول'
+    assert sent[-1][0] == driver and sent[-1][1].startswith("⚠️")
+    assert db.execute("SELECT lat, lon FROM driver_status WHERE driver_id = ?", (driver,)).fetchone() == (32.9, 13.2)
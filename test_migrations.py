@@ -0,0 +1,57 @@
+import pytest
+
+import main
+
+
+def query_plan(conn, sql, params=()):
+    return " | ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+
+
+def test_migrations_recorded(db):
+    versions = [row[0] for row in db.execute("SELECT version FROM schema_migrations ORDER BY version")]
+    assert versions == [version for version, _, _ in main.MIGRATIONS]
+    assert main.get_schema_version() == main.MIGRATIONS[-1][0]
+
+
+def test_initialize_db_is_idempotent(db):
+    main.initialize_db()
+    assert db.execute("SELECT COUNT(*) FROM schema_migrations").fetchone()[0] == len(main.MIGRATIONS)
+
+
+@pytest.mark.parametrize("sql, params, index", [
+    ("""
+        SELECT d.driver_id, d.lat, d.lon, u.gender, u.balance FROM driver_status d
+        JOIN users u ON d.driver_id = u.telegram_id
+        WHERE d.status = 'متوفر' AND d.lat IS NOT NULL AND d.lon IS NOT NULL
+    """, (), "idx_driver_status_available"),
+    ("""
+        SELECT d.driver_id, d.lat, d.lon FROM driver_status d
+        JOIN users u ON d.driver_id = u.telegram_id
+        WHERE d.status = 'متوفر' AND u.gender = ? AND u.balance >= ?
+    """, ("ذكر", 2), "idx_driver_status_available"),
+    ("SELECT id, passenger_id FROM trips WHERE driver_id = ?", (1,), "idx_trips_driver_id"),
+    ("SELECT * FROM trips WHERE passenger_id = ?", (1,), "idx_trips_passenger_id"),
+    (
+        "SELECT telegram_id, username, role, gender, balance, admin FROM users WHERE LOWER(username) = ?",
+        ("driver",), "idx_users_username_lower"
+    ),
+    (
+        "SELECT COALESCE(SUM(amount), 0), COUNT(*) FROM balance_ledger WHERE user_id = ? AND id > ?",
+        (1, 0), "idx_balance_ledger_user"
+    ),
+    (
+        "SELECT balance, ledger_id FROM balance_snapshots WHERE user_id = ? ORDER BY id DESC LIMIT 1",
+        (1,), "idx_balance_snapshots_user"
+    ),
+    ("SELECT status FROM trip_events WHERE trip_id = ? ORDER BY id", (1,), "idx_trip_events_trip"),
+    ("SELECT trip_id FROM trip_offers WHERE driver_id = ? AND status = 'open'", (1,), "idx_trip_offers_driver_open"),
+])
+def test_query_uses_index(db, sql, params, index):
+    plan = query_plan(db, sql, params)
+    assert "SEARCH" in plan and index in plan, plan
+
+
+def test_status_index_replaced(db):
+    indexes = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert "idx_driver_status_status" not in indexes
+    assert "idx_driver_status_available" in indexes
@@ -0,0 +1,67 @@
+import threading
+
+import main
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+        self.gate = threading.Event()
+        self.blocked = threading.Event()
+
+    def send_message(self, chat_id, text, **kwargs):
+        if text == "block":
+            self.blocked.set()
+            self.gate.wait(5)
+        self.sent.append((chat_id, text))
+
+
+def make_queue(monkeypatch):
+    fake = FakeBot()
+    monkeypatch.setattr(main, "bot", fake)
+    queue = main.OutboundQueue(workers=1, global_rate=1000, chat_rate=1000, chat_burst=1000)
+    # العامل الوحيد مشغول برسالة حتى تُضاف بقية الرسائل
+    queue.put(0, "block")
+    assert fake.blocked.wait(5)
+    return fake, queue
+
+
+def test_chat_keeps_order_across_priorities(monkeypatch):
+    fake, queue = make_queue(monkeypatch)
+    queue.put(1, "trip sent, waiting for driver", main.PRIORITY_NORMAL)
+    queue.put(1, "no driver available", main.PRIORITY_TRIP)
+    fake.gate.set()
+    assert queue.flush(5)
+    assert [text for chat_id, text in fake.sent if chat_id == 1] == [
+        "trip sent, waiting for driver", "no driver available"
+    ]
+
+
+def test_priority_picks_next_chat(monkeypatch):
+    fake, queue = make_queue(monkeypatch)
+    queue.put(1, "menu", main.PRIORITY_MENU)
+    queue.put(2, "offer", main.PRIORITY_TRIP)
+    fake.gate.set()
+    assert queue.flush(5)
+    assert [chat_id for chat_id, _ in fake.sent] == [0, 2, 1]
+
+
+def test_retry_keeps_chat_order(monkeypatch):
+    fake, queue = make_queue(monkeypatch)
+    failures = []
+    send = fake.send_message
+
+    def flaky(chat_id, text, **kwargs):
+        if text == "first" and not failures:
+            failures.append(text)
+            raise ConnectionError("timeout")
+        send(chat_id, text, **kwargs)
+
+    monkeypatch.setattr(fake, "send_message", flaky)
+    monkeypatch.setattr(queue, "_retry", lambda item, delay: main.OutboundQueue._retry(queue, item, 0.01))
+    queue.put(1, "first")
+    queue.put(1, "second")
+    fake.gate.set()
+    assert queue.flush(5)
+    assert [text for chat_id, text in fake.sent if chat_id == 1] == ["first", "second"]
+    assert queue.retries == 1
@@ -0,0 +1,45 @@
+import threading
+import time
+
+import main
+
+
+def test_restart_within_interval_keeps_one_sampler():
+    profiler = main.SamplingProfiler(interval=0.5)
+    assert profiler.start()
+    first = profiler.thread
+    profiler.stop()
+    assert profiler.start()
+    second = profiler.thread
+    try:
+        first.join(1)
+        assert not first.is_alive()
+        assert second.is_alive()
+        assert not profiler.start()
+    finally:
+        profiler.stop()
+    second.join(1)
+    assert not second.is_alive()
+    assert not profiler.running
+
+
+def test_samples_counted_once_per_tick():
+    profiler = main.SamplingProfiler(interval=0.05)
+    worker_stop = threading.Event()
+
+    def idle_worker():
+        worker_stop.wait()
+
+    worker = threading.Thread(target=idle_worker)
+    worker.start()
+    profiler.start()
+    profiler.stop()
+    profiler.start()
+    time.sleep(0.3)
+    profiler.stop()
+    profiler.thread.join(1)
+    worker_stop.set()
+    worker.join()
+    ticks = sum(count for stack, count in profiler.samples.items() if "idle_worker" in stack)
+    # ~6 عينات في 0.3 ثانية؛ خيطان يعدّان معًا يضاعفانها
+    assert ticks <= 0.3 / 0.05 + 2
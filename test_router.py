@@ -0,0 +1,82 @@
+import pytest
+from telebot import types
+
+import main
+from webhook_client import fake_location_update, fake_text_update
+
+DRIVER, PASSENGER, ADMIN, STRANGER, UNREGISTERED = 1, 2, 3, 4, 5
+
+
+@pytest.fixture
+def users(db, monkeypatch):
+    monkeypatch.setattr(main, "send_message", lambda chat_id, text, *args, **kwargs: sent.append((chat_id, text)))
+    sent = []
+    main.set_user(DRIVER, "driver", "سائق", "ذكر")
+    main.set_user(PASSENGER, "passenger", "راكب", "أنثى")
+    main.set_user(ADMIN, "admin", "أدمن", admin=1)
+    # دور الأدمن بدون صلاحية (لم تُدخل كلمة المرور بعد)
+    main.set_user(STRANGER, "stranger", "أدمن", admin=0)
+    yield sent
+    for user_id in (DRIVER, PASSENGER, ADMIN, STRANGER, UNREGISTERED):
+        main.user_cache.invalidate(user_id)
+
+
+def message(update):
+    return types.Update.de_json(update).message
+
+
+def route_name(user_id, text):
+    handler = main.find_route(main.UpdateContext(message(fake_text_update(user_id, text))))
+    return handler.__name__ if handler else None
+
+
+@pytest.mark.parametrize("user_id, text, handler", [
+    (DRIVER, 'متوفر ✅', "driver_available"),
+    (DRIVER, 'عرض الرصيد 💰', "driver_balance"),
+    (DRIVER, 'طلب رحلة 🛺', "driver_menu"),
+    (PASSENGER, 'طلب رحلة 🛺', "passenger_request_trip"),
+    (PASSENGER, 'متوفر ✅', "passenger_menu"),
+    (ADMIN, 'عرض بيانات مستخدم 👤', "admin_user_info"),
+    (ADMIN, 'كلام', "admin_menu"),
+    (UNREGISTERED, '/start', "start"),
+    (UNREGISTERED, 'راكب 🧍', "set_role"),
+    (UNREGISTERED, 'متوفر ✅', None),
+    (DRIVER, '/start', "start"),
+])
+def test_routes_by_role(users, user_id, text, handler):
+    assert route_name(user_id, text) == handler
+
+
+def test_command_with_bot_name_and_payload(users):
+    assert route_name(UNREGISTERED, '/start@taxi_bot') == "start"
+    assert route_name(DRIVER, '/start ref123') == "start"
+    assert route_name(DRIVER, '/start@taxi_bot') == "start"
+
+
+def test_location_routes_by_content_type(users):
+    ctx = main.UpdateContext(message(fake_location_update(PASSENGER, 32.9, 13.2)))
+    assert main.find_route(ctx).__name__ == "passenger_location"
+    ctx = main.UpdateContext(message(fake_location_update(UNREGISTERED, 32.9, 13.2)))
+    assert main.find_route(ctx) is None
+
+
+def test_admin_only_refuses_without_admin_flag(users):
+    main.router(message(fake_text_update(STRANGER, 'عرض بيانات مستخدم 👤')))
+    assert users == [(STRANGER, "ليس لديك صلاحية الأدمن.")]
+    main.router(message(fake_text_update(ADMIN, 'عرض بيانات مستخدم 👤')))
+    assert users[-1] == (ADMIN, "ادخل @username:")
+
+
+def test_user_read_at_most_once_per_update(users, monkeypatch):
+    calls = []
+    get_user = main.get_user
+
+    def counting_get_user(telegram_id):
+        calls.append(telegram_id)
+        return get_user(telegram_id)
+
+    monkeypatch.setattr(main, "get_user", counting_get_user)
+    for user_id, text in [(DRIVER, 'عرض الرصيد 💰'), (PASSENGER, 'كلام'), (UNREGISTERED, 'كلام'), (ADMIN, 'عرض بيانات مستخدم 👤')]:
+        calls.clear()
+        main.router(message(fake_text_update(user_id, text)))
+        assert calls == [user_id]
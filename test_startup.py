@@ -0,0 +1,22 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_python(code, tmp_path):
+    env = {k: v for k, v in os.environ.items() if k != "TELEGRAM_API_TOKEN"}
+    env["DATABASE_NAME"] = str(tmp_path / "bot.sqlite3")
+    return subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, timeout=60)
+
+
+def test_import_without_token(tmp_path):
+    result = run_python("import main", tmp_path)
+    assert result.returncode == 0, result.stderr
+
+
+def test_run_bot_requires_token(tmp_path):
+    result = run_python("import main; main.run_bot()", tmp_path)
+    assert result.returncode == 1
+    assert "TELEGRAM_API_TOKEN" in result.stderr
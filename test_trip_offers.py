@@ -0,0 +1,164 @@
+import time
+from contextlib import contextmanager
+
+import pytest
+
+import main
+
+DRIVERS = (1, 2, 3)
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    messages = []
+    monkeypatch.setattr(main, "send_message", lambda chat_id, text, *args, **kwargs: messages.append((chat_id, text)))
+    return messages
+
+
+@pytest.fixture
+def trip(db, sent):
+    for driver_id in DRIVERS:
+        main.set_user(driver_id, f"driver{driver_id}", "سائق", "ذكر", balance=10)
+        main.driver_index.upsert(driver_id, 32.88 + driver_id / 1000, 13.19, "ذكر", 10)
+    trip = {"passenger_id": 100, "passenger_name": "p", "gender": "ذكر", "start": (32.88, 13.19),
+            "destination": "x", "price": 10}
+    trip["trip_id"] = main.add_trip(trip)
+    yield trip
+    for driver_id in DRIVERS:
+        main.driver_index.remove(driver_id)
+        main.user_cache.invalidate(driver_id)
+
+
+def trip_driver(db, trip_id):
+    row = db.execute("SELECT driver_id FROM trips WHERE id = ?", (trip_id,)).fetchone()
+    return row[0] if row else None
+
+
+def test_reject_offers_next_candidate(db, trip, sent):
+    offers = main.TripOffers("sequential", timeout=60)
+    offers.start(trip, [1, 2])
+    assert offers.offered_trip(1) == trip["trip_id"]
+    assert offers.reject(1, trip["trip_id"])
+    assert offers.offered_trip(2) == trip["trip_id"]
+    assert offers.accept(2, trip["trip_id"])["trip_id"] == trip["trip_id"]
+    assert trip_driver(db, trip["trip_id"]) == 2
+
+
+def test_first_accept_wins_and_withdraws_others(db, trip, sent):
+    offers = main.TripOffers("fanout", fanout=3, timeout=60)
+    offers.start(trip, list(DRIVERS))
+    assert offers.accept(2, trip["trip_id"])
+    assert offers.accept(1, trip["trip_id"]) is None
+    assert trip_driver(db, trip["trip_id"]) == 2
+    withdrawn = {chat_id for chat_id, text in sent if text.startswith("🚫")}
+    assert withdrawn == {1, 3}
+    assert len(offers) == 0
+
+
+def test_reject_during_accept_does_not_cancel_trip(db, trip, sent, monkeypatch):
+    offers = main.TripOffers("fanout", fanout=2, timeout=60)
+    offers.start(trip, [1, 2])
+    transaction = main.db_transaction
+    raced = []
+
+    @contextmanager
+    def racing_transaction():
+        # الرفض يصل بين حجز عرض السائق 1 و compare-and-set الخاص به
+        if not raced:
+            raced.append(None)
+            raced[0] = offers.reject(2, trip["trip_id"])
+        with transaction() as conn:
+            yield conn
+
+    monkeypatch.setattr(main, "db_transaction", racing_transaction)
+    assert offers.accept(1, trip["trip_id"])
+    assert raced == [True]
+    assert trip_driver(db, trip["trip_id"]) == 1
+    assert db.execute("SELECT COUNT(*) FROM trip_history").fetchone()[0] == 0
+    assert not [text for chat_id, text in sent if chat_id == trip["passenger_id"]]
+
+
+def test_no_candidates_cancels_trip(db, trip, sent):
+    offers = main.TripOffers("sequential", timeout=60)
+    offers.start(trip, [])
+    assert db.execute("SELECT status FROM trip_history WHERE id = ?", (trip["trip_id"],)).fetchone() == ("cancelled",)
+    assert [chat_id for chat_id, text in sent if text.startswith("❌")] == [trip["passenger_id"]]
+
+
+def test_other_process_can_answer_offer(db, trip, sent):
+    # العملية التي أرسلت العرض ليست بالضرورة من يستقبل رد السائق
+    sender = main.TripOffers("sequential", timeout=60)
+    receiver = main.TripOffers("sequential", timeout=60)
+    sender.start(trip, [1, 2, 3])
+    assert receiver.offered_trip(1) == trip["trip_id"]
+    assert receiver.reject(1, trip["trip_id"])
+    second = receiver.offered_trip(2) or receiver.offered_trip(3)
+    assert second == trip["trip_id"]
+    driver_id = 2 if receiver.offered_trip(2) else 3
+    assert sender.accept(driver_id, trip["trip_id"])
+    assert trip_driver(db, trip["trip_id"]) == driver_id
+    assert sender.offered_trip(1) is None
+    sender.expire(trip["trip_id"], 1)
+    assert not [text for chat_id, text in sent if text.startswith("⌛")]
+
+
+def test_recover_reoffers_orphaned_trip(db, trip, sent):
+    main.TripOffers("sequential", timeout=60).start(trip, [1])
+    with main.db_transaction() as conn:
+        conn.execute("UPDATE trip_offers SET expires_at = 0")
+    restarted = main.TripOffers("sequential", timeout=60)
+    restarted.recover()
+    # العرض القديم انتهت مهلته أثناء التوقف، والرحلة تُعرض على المرشح التالي
+    for _ in range(200):
+        if restarted.offered_trip(2) == trip["trip_id"]:
+            break
+        time.sleep(0.01)
+    assert restarted.offered_trip(2) == trip["trip_id"]
+    assert db.execute("SELECT status FROM trip_offers WHERE trip_id = ? AND driver_id = 1", (trip["trip_id"],)).fetchone() == ("expired",)
+
+
+def test_recover_cancels_trip_without_candidates(db, trip, sent):
+    for driver_id in DRIVERS:
+        main.driver_index.remove(driver_id)
+    main.TripOffers("sequential", timeout=60).recover()
+    assert db.execute("SELECT status FROM trip_history WHERE id = ?", (trip["trip_id"],)).fetchone() == ("cancelled",)
+    assert [chat_id for chat_id, text in sent if text.startswith("❌")] == [trip["passenger_id"]]
+
+
+def new_trip(passenger_id):
+    trip = {"passenger_id": passenger_id, "passenger_name": "p", "gender": "ذكر", "start": (32.88, 13.19),
+            "destination": "y", "price": 10}
+    trip["trip_id"] = main.add_trip(trip)
+    return trip
+
+
+def test_driver_on_trip_is_not_offered_another(db, trip, sent):
+    offers = main.TripOffers("sequential", timeout=60)
+    offers.start(trip, [1])
+    assert offers.accept(1, trip["trip_id"])
+    second = new_trip(101)
+    assert 1 not in [driver_id for _, driver_id in main.rank_candidates(second)]
+    offers.start(second, [1, 2])
+    assert offers.offered_trip(1) is None
+    assert offers.offered_trip(2) == second["trip_id"]
+    assert db.execute("SELECT id, driver_id FROM trips ORDER BY id").fetchall() == [(trip["trip_id"], 1), (second["trip_id"], None)]
+
+
+def test_accept_refused_while_driver_is_on_trip(db, trip, sent):
+    offers = main.TripOffers("sequential", timeout=60)
+    offers.start(trip, [1])
+    second = new_trip(101)
+    # عرض قديم بقي مفتوحًا (مثلًا من عملية أخرى) لا يمنح السائق رحلة ثانية
+    with main.db_transaction() as conn:
+        conn.execute("INSERT INTO trip_offers (trip_id, driver_id, status, expires_at) VALUES (?, 1, 'open', 0)", (second["trip_id"],))
+    assert offers.accept(1, trip["trip_id"])
+    assert offers.accept(1, second["trip_id"]) is None
+    assert trip_driver(db, second["trip_id"]) is None
+
+
+def test_expire_sends_neutral_message(db, trip, sent):
+    offers = main.TripOffers("sequential", timeout=60)
+    offers.start(trip, [1])
+    offers.expire(trip["trip_id"], 1)
+    assert (1, "⌛ انتهت مهلة العرض.") in sent
+    assert [chat_id for chat_id, text in sent if text.startswith("❌")] == [trip["passenger_id"]]
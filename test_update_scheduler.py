@@ -0,0 +1,80 @@
+import threading
+
+from telebot import types
+
+import main
+from webhook_client import fake_text_update
+
+MENU = 'عرض الرصيد 💰'
+TRIP = '/قبول ✅'
+NORMAL = '12.5'
+
+
+class FakeBot:
+    def __init__(self):
+        self.processed = []
+        self.done = threading.Event()
+        self.expected = 0
+
+    def process_now(self, updates):
+        for update in updates:
+            self.processed.append((update.message.chat.id, update.message.text))
+        if len(self.processed) >= self.expected:
+            self.done.set()
+
+
+def update(chat_id, text):
+    return types.Update.de_json(fake_text_update(chat_id, text))
+
+
+def run(monkeypatch, scheduler, updates):
+    # كل التحديثات تُضاف قبل تشغيل العامل الوحيد، فالترتيب يحدده المجدول وحده
+    fake = FakeBot()
+    fake.expected = len(updates)
+    monkeypatch.setattr(main, "bot", fake)
+    for item in updates:
+        assert scheduler.submit(item)
+    scheduler.start()
+    assert fake.done.wait(5)
+    return fake.processed
+
+
+def test_priorities_match_routes():
+    assert main.update_priority(update(1, MENU)) == main.PRIORITY_MENU
+    assert main.update_priority(update(1, TRIP)) == main.PRIORITY_TRIP
+    assert main.update_priority(update(1, NORMAL)) == main.PRIORITY_NORMAL
+
+
+def test_chat_keeps_order_across_priorities(monkeypatch):
+    scheduler = main.UpdateScheduler(workers=1, max_pending=10)
+    processed = run(monkeypatch, scheduler, [update(1, MENU), update(1, NORMAL), update(1, TRIP)])
+    assert processed == [(1, MENU), (1, NORMAL), (1, TRIP)]
+
+
+def test_trip_update_jumps_ahead_of_other_chats_menus(monkeypatch):
+    scheduler = main.UpdateScheduler(workers=1, max_pending=10)
+    processed = run(monkeypatch, scheduler, [update(1, MENU), update(2, MENU), update(3, TRIP)])
+    assert processed[0] == (3, TRIP)
+    assert processed[1:] == [(1, MENU), (2, MENU)]
+
+
+def test_menu_updates_shed_with_busy_reply(monkeypatch):
+    sent = []
+    monkeypatch.setattr(main, "send_message", lambda chat_id, text, *args, **kwargs: sent.append((chat_id, text)))
+    scheduler = main.UpdateScheduler(workers=1, max_pending=4, shed_at=0.5)
+    assert scheduler.submit(update(1, MENU))
+    assert scheduler.submit(update(2, MENU))
+    assert not scheduler.submit(update(3, MENU))
+    assert sent == [(3, "⏳ البوت مشغول حاليًا، حاول مرة أخرى بعد قليل.")]
+    # تحديثات الرحلات لا تُسقط عند حد الإسقاط
+    assert scheduler.submit(update(4, TRIP))
+    assert len(scheduler) == 3
+    assert scheduler.depth == {main.PRIORITY_TRIP: 1, main.PRIORITY_NORMAL: 0, main.PRIORITY_MENU: 2}
+
+
+def test_full_queue_rejects_without_blocking():
+    scheduler = main.UpdateScheduler(workers=1, max_pending=2, shed_at=1)
+    assert scheduler.submit(update(1, TRIP), block=False)
+    assert scheduler.submit(update(2, TRIP), block=False)
+    assert not scheduler.submit(update(3, TRIP), block=False)
+    assert len(scheduler) == 2
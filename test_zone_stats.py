@@ -0,0 +1,104 @@
+import pytest
+
+import main
+
+LOC = (32.88, 13.19)
+FAR = (30.01, 17.01)
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(1_000_000.0)
+    monkeypatch.setattr(main.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def stats(clock, monkeypatch):
+    # نافذة 5 دقائق من 5 شرائح كل منها دقيقة
+    stats = main.ZoneStats(cell_deg=0.05, window=300, bucket_seconds=60)
+    monkeypatch.setattr(main, "zone_stats", stats)
+    return stats
+
+
+def test_records_sum_within_window(stats, clock):
+    stats.record(LOC, "requests", price=10)
+    clock.now += 60
+    stats.record(LOC, "requests", price=20)
+    stats.record(LOC, "matches")
+    stats.record(FAR, "unmatched")
+    summary = stats.summary(stats.zone_of(*LOC))
+    assert summary["requests"] == 2
+    assert summary["matches"] == 1
+    assert summary["unmatched"] == 0
+    assert summary["average_price"] == 15
+
+
+def test_bucket_rollover_resets_reused_slot(stats, clock):
+    stats.record(LOC, "requests")
+    # بعد دورة كاملة تعود نفس الخانة في الحلقة لشريحة جديدة
+    clock.now += 300
+    stats.record(LOC, "requests")
+    stats.record(LOC, "requests")
+    zone = stats.zone_of(*LOC)
+    assert stats.summary(zone)["requests"] == 2
+    assert sum(bucket[1] for bucket in stats.zones[zone]) == 2
+
+
+def test_window_expiry(stats, clock):
+    stats.record(LOC, "requests")
+    clock.now += 4 * 60
+    assert stats.summary(stats.zone_of(*LOC))["requests"] == 1
+    clock.now += 60
+    assert stats.summary(stats.zone_of(*LOC))["requests"] == 0
+
+
+def test_idle_zones_pruned_by_top_zones(stats, clock):
+    stats.record(FAR, "requests")
+    stats.move_driver(None, stats.zone_of(*LOC))
+    clock.now += 600
+    assert [zone for zone, _ in stats.top_zones()] == [stats.zone_of(*LOC)]
+    assert stats.zone_of(*FAR) not in stats.zones
+
+
+def test_driver_index_keeps_zone_counts(stats):
+    index = main.DriverIndex()
+    zone, far = stats.zone_of(*LOC), stats.zone_of(*FAR)
+    index.upsert(1, *LOC, "ذكر", 10)
+    index.upsert(2, *LOC, "ذكر", 10)
+    assert stats.drivers == {zone: 2}
+    # تحرك داخل نفس المنطقة لا يغير العد
+    index.move(1, LOC[0] + 0.001, LOC[1])
+    assert stats.drivers == {zone: 2}
+    index.move(1, *FAR)
+    assert stats.drivers == {zone: 1, far: 1}
+    index.upsert(2, *FAR, "ذكر", 10)
+    assert stats.drivers == {far: 2}
+    index.remove(1)
+    index.remove(2)
+    index.remove(2)
+    assert stats.drivers == {}
+
+
+def test_search_limits_widen_when_under_supplied(stats, monkeypatch):
+    monkeypatch.setattr(main, "ZONE_DEMAND_RATIO", 2)
+    monkeypatch.setattr(main, "ZONE_WIDEN_FACTOR", 2)
+    zone = stats.zone_of(*LOC)
+    # بلا سائقين: توسيع
+    assert stats.search_limits(LOC, 10, 5) == (20, 10)
+    stats.move_driver(None, zone)
+    assert stats.search_limits(LOC, 10, 5) == (10, 5)
+    for _ in range(2):
+        stats.record(LOC, "requests")
+    assert stats.search_limits(LOC, 10, 5) == (10, 5)
+    # الطلبات تتجاوز السائقين × النسبة
+    stats.record(LOC, "requests")
+    assert stats.search_limits(LOC, 10, 5) == (20, 10)
@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+import urllib.request
+import urllib.error
+
+# عميل محلي يحاكي تيليجرام ويرسل تحديثات إلى خادم الـ webhook (للاختبار بدون إنترنت)
+# الاستخدام: python webhook_client.py [عدد التحديثات] [عدد الخيوط]
+
+WEBHOOK_TARGET = os.environ.get("WEBHOOK_TARGET", "http://127.0.0.1:%s%s" % (
+    os.environ.get("WEBHOOK_PORT", "8443"), os.environ.get("WEBHOOK_PATH", "/webhook")
+))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+
+_update_id = 0
+_update_lock = threading.Lock()
+
+def next_update_id():
+    global _update_id
+    with _update_lock:
+        _update_id += 1
+        return _update_id
+
+def fake_message(user_id, **content):
+    update_id = next_update_id()
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+    }
+    message.update(content)
+    return {"update_id": update_id, "message": message}
+
+def fake_text_update(user_id, text):
+    return fake_message(user_id, text=text)
+
+def fake_location_update(user_id, lat, lon):
+    return fake_message(user_id, location={"latitude": lat, "longitude": lon})
+
+def post_update(update, url=WEBHOOK_TARGET, secret=WEBHOOK_SECRET):
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), method="POST")
+    request.add_header("Content-Type", "application/json")
+    if secret:
+        request.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+def run_load_test(count, concurrency, url=WEBHOOK_TARGET, secret=WEBHOOK_SECRET):
+    # يرسل count تحديث نصي موزعة على concurrency خيط ويرجع الإحصائيات
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    texts = ['عرض الرصيد 💰', 'متوفر ✅', 'طلب رحلة 🛺', '/start']
+
+    def worker(n):
+        for _ in range(n):
+            update = fake_text_update(random.randint(1, 1000), random.choice(texts))
+            started = time.perf_counter()
+            status = post_update(update, url, secret)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(count // concurrency + (i < count % concurrency),)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "updates": len(latencies),
+        "seconds": total,
+        "updates_per_second": len(latencies) / total if total else 0,
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else 0,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000 if latencies else 0,
+        "statuses": statuses
+    }
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    print(json.dumps(run_load_test(count, concurrency), indent=2))